@@ -0,0 +1,152 @@
+"""Inputs and results of the Amber benchmarks run by ``spack test``.
+
+The benchmark directories of the Amber sources drive each run from a
+``bench.<system>`` shell script, which writes the namelist with a
+here-document and names the topology and coordinates on the command line,
+e.g. ``$sander -O -i mdin -c inpcrd.equil -o mdout.jac``. Directories with
+plain ``mdin``, ``prmtop`` and ``inpcrd`` files are understood as well.
+
+This module does not depend on Spack, so that it can be tested on its own.
+"""
+
+import glob
+import gzip
+import os
+import re
+import shlex
+import shutil
+
+# file names sander and pmemd read when -p or -c is not given
+_default_prmtop = "prmtop"
+_default_inpcrd = "inpcrd"
+
+
+def find_input(directory, patterns):
+    """Return the first file in ``directory`` matching one of ``patterns``."""
+    for pattern in patterns:
+        matches = sorted(glob.glob(os.path.join(directory, pattern)))
+        if matches:
+            return matches[0]
+    return None
+
+
+def _scan_script(text):
+    """Split a shell script into here-documents and command lines.
+
+    Returns ``({file: contents}, [command])`` for the here-documents that
+    are redirected into a file and the remaining, joined, command lines.
+    """
+    documents, commands = {}, []
+    lines = text.splitlines()
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        i += 1
+        while line.endswith("\\") and i < len(lines):
+            line = line[:-1] + " " + lines[i]
+            i += 1
+        start = re.search(r"<<-?\s*['\"]?(\w+)['\"]?", line)
+        if not start:
+            commands.append(line)
+            continue
+        body = []
+        while i < len(lines) and lines[i].strip() != start.group(1):
+            body.append(lines[i])
+            i += 1
+        i += 1
+        target = re.search(r"(?<!<)>\s*([^\s<>;&|]+)", line)
+        if target:
+            documents[target.group(1)] = "\n".join(body) + "\n"
+    return documents, commands
+
+
+def parse_bench_script(text):
+    """Return ``(mdin, prmtop, inpcrd)`` of a ``bench.<system>`` script.
+
+    ``mdin`` is the text of the namelist the script writes, ``prmtop`` and
+    ``inpcrd`` the file names given to the engine. Returns None if the
+    script runs no engine or does not write its namelist.
+    """
+    documents, commands = _scan_script(text)
+    for command in commands:
+        try:
+            tokens = shlex.split(command, comments=True)
+        except ValueError:
+            continue
+        if "-o" not in tokens and "-O" not in tokens:
+            continue
+        options = {}
+        for flag, value in zip(tokens, tokens[1:]):
+            if flag in ("-i", "-p", "-c"):
+                options[flag] = value
+        mdin = documents.get(options.get("-i", "mdin"))
+        if mdin is None:
+            continue
+        return mdin, options.get("-p", _default_prmtop), options.get("-c", _default_inpcrd)
+    return None
+
+
+def _existing(directory, name):
+    """Return ``name`` in ``directory``, or its gzipped copy, or None."""
+    for candidate in (name, name + ".gz"):
+        path = os.path.join(directory, candidate)
+        if os.path.isfile(path):
+            return path
+    return None
+
+
+def benchmark_inputs(directory):
+    """Return the ``(mdin text, prmtop, inpcrd)`` of a benchmark, or None."""
+    for script in sorted(glob.glob(os.path.join(directory, "bench.*"))):
+        with open(script, errors="replace") as f:
+            parsed = parse_bench_script(f.read())
+        if parsed is None:
+            continue
+        mdin, prmtop, inpcrd = parsed
+        prmtop, inpcrd = _existing(directory, prmtop), _existing(directory, inpcrd)
+        if prmtop and inpcrd:
+            return mdin, prmtop, inpcrd
+
+    mdin = find_input(directory, ["mdin", "mdin.*", "*.mdin", "*.in"])
+    prmtop = find_input(directory, ["prmtop", "*.prmtop", "*.parm7", "*.top"])
+    inpcrd = find_input(directory, ["inpcrd", "inpcrd.*", "*.inpcrd", "*.rst7", "*.crd"])
+    if not (mdin and prmtop and inpcrd):
+        return None
+    with open(mdin) as f:
+        return f.read(), prmtop, inpcrd
+
+
+def uncompressed(path, workdir):
+    """Return ``path``, or a decompressed copy in ``workdir`` if it is gzipped."""
+    if not path.endswith(".gz"):
+        return path
+    dest = os.path.join(workdir, os.path.basename(path)[: -len(".gz")])
+    with gzip.open(path, "rb") as src, open(dest, "wb") as out:
+        shutil.copyfileobj(src, out)
+    return dest
+
+
+def parse_mdout(text):
+    """Extract the run length and the performance from a pmemd/sander mdout.
+
+    pmemd reports ns/day itself; for sander it is derived from the number
+    of steps, the time step and the total wall time.
+    """
+    result = {}
+    match = re.search(r"nstlim\s*=\s*(\d+)", text)
+    if match:
+        result["steps"] = int(match.group(1))
+    match = re.search(r"\bdt\s*=\s*([\d.]+)", text)
+    if match:
+        result["dt_ps"] = float(match.group(1))
+    match = re.findall(r"Total wall time:\s*([\d.]+)\s*seconds", text)
+    if match:
+        result["wall_seconds"] = float(match[-1])
+    match = re.findall(r"ns/day\s*=\s*([\d.]+)", text)
+    if match:
+        # the last value is averaged over all steps
+        result["ns_per_day"] = float(match[-1])
+    elif all(k in result for k in ("steps", "dt_ps", "wall_seconds")) and result["wall_seconds"]:
+        simulated_ns = result["steps"] * result["dt_ps"] / 1000.0
+        result["ns_per_day"] = round(simulated_ns * 86400.0 / result["wall_seconds"], 3)
+    return result
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+
+"""Run an Amber executable with OpenMP threads pinned to the node topology.
+
+The topology is read from sysfs, or from /proc/cpuinfo when sysfs does not
+describe it. The physical cores of the node are split among the MPI ranks
+running on it, keeping every rank within one NUMA domain where possible.
+The helper then sets OMP_NUM_THREADS, OMP_PLACES and OMP_PROC_BIND for its
+rank and executes the command. The local rank and the number of ranks on
+the node come from the environment set by Open MPI, MPICH, Intel MPI or
+Slurm. A rank that the launcher already bound to its own CPUs keeps all of
+them; CPUs shared by all ranks, such as a job's cpuset, are split. With
+more ranks than cores the hardware threads are split instead, and with more
+ranks than hardware threads the command runs unpinned.
+
+    mpirun -np 2 amber-launch pmemd.MPI -O -i mdin ...
+    amber-launch --ranks 4 --print
+
+The layout that was chosen is printed to stderr. ``--sysfs-root`` and
+``--proc-root`` read the topology from another directory tree, which is
+handy to check the layout for a different node type.
+"""
+
+import argparse
+import glob
+import os
+import re
+import sys
+
+# (rank, number of ranks) variables of the supported launchers
+_LOCAL_RANK_VARS = [
+    ("OMPI_COMM_WORLD_LOCAL_RANK", "OMPI_COMM_WORLD_LOCAL_SIZE"),
+    ("MPI_LOCALRANKID", "MPI_LOCALNRANKS"),
+    ("PMI_LOCAL_RANK", "PMI_LOCAL_SIZE"),
+]
+
+# Slurm task counts per node, of the step first, in the ``4(x2),3`` format
+_SLURM_TASKS_VARS = ["SLURM_STEP_TASKS_PER_NODE", "SLURM_TASKS_PER_NODE", "SLURM_NTASKS_PER_NODE"]
+
+
+def parse_cpulist(text):
+    """Expand a sysfs CPU list such as ``0-3,8,10-11`` into a list of ints."""
+    cpus = []
+    for part in text.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def parse_tasks_per_node(text):
+    """Expand a Slurm task count list such as ``4(x2),3`` into ``[4, 4, 3]``."""
+    counts = []
+    for part in text.split(","):
+        match = re.match(r"^(\d+)(?:\(x(\d+)\))?$", part.strip())
+        if not match:
+            return []
+        counts.extend([int(match.group(1))] * int(match.group(2) or 1))
+    return counts
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _read_sysfs(sysfs_root):
+    """Return ``{cpu: (package, core)}`` and ``{node: [cpus]}`` from sysfs."""
+    cpu_root = os.path.join(sysfs_root, "devices", "system", "cpu")
+    online = _read(os.path.join(cpu_root, "online"))
+    if online is None:
+        return {}, {}
+    cpus = {}
+    for cpu in parse_cpulist(online):
+        topology = os.path.join(cpu_root, "cpu{0}".format(cpu), "topology")
+        package = _read(os.path.join(topology, "physical_package_id"))
+        core = _read(os.path.join(topology, "core_id"))
+        if package is None or core is None:
+            return {}, {}
+        cpus[cpu] = (int(package), int(core))
+
+    nodes = {}
+    for path in glob.glob(os.path.join(sysfs_root, "devices", "system", "node", "node*")):
+        cpulist = _read(os.path.join(path, "cpulist"))
+        suffix = os.path.basename(path)[len("node") :]
+        if cpulist and suffix.isdigit():
+            nodes[int(suffix)] = [cpu for cpu in parse_cpulist(cpulist) if cpu in cpus]
+    return cpus, {node: members for node, members in nodes.items() if members}
+
+
+def _read_cpuinfo(proc_root):
+    """Return ``{cpu: (package, core)}`` from /proc/cpuinfo."""
+    text = _read(os.path.join(proc_root, "cpuinfo")) or ""
+    cpus = {}
+    for block in text.split("\n\n"):
+        fields = {}
+        for line in block.splitlines():
+            key, _, value = line.partition(":")
+            fields[key.strip()] = value.strip()
+        if "processor" not in fields:
+            continue
+        cpu = int(fields["processor"])
+        # without core information every processor is a core of its own
+        cpus[cpu] = (int(fields.get("physical id", 0)), int(fields.get("core id", cpu)))
+    return cpus
+
+
+class Topology(object):
+    """Cores of a node grouped by NUMA node.
+
+    ``domains`` is a list of NUMA domains, each a list of cores, and each
+    core a sorted list of its hardware threads.
+    """
+
+    def __init__(self, domains):
+        self.domains = domains
+
+    @classmethod
+    def detect(cls, sysfs_root="/sys", proc_root="/proc", allowed=None):
+        """Read the topology, restricted to the CPUs in ``allowed``."""
+        cpus, nodes = _read_sysfs(sysfs_root)
+        if not cpus:
+            cpus = _read_cpuinfo(proc_root)
+        if allowed is not None:
+            cpus = {cpu: core for cpu, core in cpus.items() if cpu in allowed}
+        if not cpus:
+            raise RuntimeError("Unable to read the CPU topology")
+        if not nodes:
+            # one domain per socket
+            nodes = {}
+            for cpu, (package, _) in cpus.items():
+                nodes.setdefault(package, []).append(cpu)
+
+        domains = []
+        for node in sorted(nodes):
+            cores = {}
+            for cpu in nodes[node]:
+                if cpu in cpus:
+                    cores.setdefault(cpus[cpu], []).append(cpu)
+            if cores:
+                domains.append(sorted((sorted(t) for t in cores.values()), key=lambda t: t[0]))
+        return cls(domains)
+
+    @property
+    def cores(self):
+        return [core for domain in self.domains for core in domain]
+
+    def layout(self, ranks):
+        """Assign the cores to ``ranks`` ranks, returning a list per rank.
+
+        With at least as many ranks as NUMA domains, every domain gets a
+        number of ranks in proportion to its cores and no rank straddles two
+        domains, although ranks of different domains may then get different
+        thread counts. With fewer ranks than domains, each rank gets whole,
+        consecutive domains.
+        """
+        if ranks < 1:
+            raise ValueError("The number of ranks must be positive")
+        domains = self.domains
+        if ranks < len(domains):
+            return [[c for d in group for c in d] for group in _split(domains, ranks)]
+
+        # every domain gets one rank, the rest go to the domains with the
+        # most cores per rank
+        shares = [1] * len(domains)
+        for _ in range(ranks - len(domains)):
+            i = max(range(len(domains)), key=lambda d: (len(domains[d]) / shares[d], -d))
+            shares[i] += 1
+        assignment = []
+        for domain, share in zip(domains, shares):
+            assignment.extend(_split(domain, share))
+        return assignment
+
+    def threads(self):
+        """Return the topology with every hardware thread as a core of its own."""
+        return Topology([[[t] for core in domain for t in core] for domain in self.domains])
+
+
+def fit(topology, ranks):
+    """Return ``topology``, or its hardware threads as cores, to hold ``ranks``.
+
+    With more ranks than cores, as with one rank per hardware thread, the
+    hardware threads are split instead. Raises ValueError with more ranks
+    than hardware threads.
+    """
+    if ranks <= len(topology.cores):
+        return topology
+    threads = topology.threads()
+    if ranks > len(threads.cores):
+        raise ValueError(
+            "{0} ranks do not fit on {1} hardware threads".format(ranks, len(threads.cores))
+        )
+    return threads
+
+
+def _split(items, parts):
+    """Split ``items`` into ``parts`` contiguous chunks of near equal size."""
+    if parts > len(items):
+        raise ValueError("{0} ranks do not fit on {1} cores".format(parts, len(items)))
+    size, extra = divmod(len(items), parts)
+    chunks, start = [], 0
+    for i in range(parts):
+        end = start + size + (1 if i < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def omp_environment(cores, smt=False):
+    """Return the OpenMP variables pinning one rank to ``cores``."""
+    places = []
+    for threads in cores:
+        if smt:
+            places.extend("{{{0}}}".format(t) for t in threads)
+        else:
+            places.append("{{{0}}}".format(",".join(str(t) for t in threads)))
+    return {
+        "OMP_NUM_THREADS": str(len(places)),
+        "OMP_PLACES": ",".join(places),
+        "OMP_PROC_BIND": "close",
+    }
+
+
+def local_rank(environ):
+    """Return ``(rank, ranks)`` on this node from the MPI launcher variables."""
+    for rank_var, size_var in _LOCAL_RANK_VARS:
+        if rank_var in environ and environ.get(size_var, "").isdigit():
+            return int(environ[rank_var]), int(environ[size_var])
+    if environ.get("SLURM_LOCALID", "").isdigit():
+        node = environ.get("SLURM_NODEID", "0")
+        node = int(node) if node.isdigit() else 0
+        for var in _SLURM_TASKS_VARS:
+            counts = parse_tasks_per_node(environ.get(var, ""))
+            if node < len(counts):
+                return int(environ["SLURM_LOCALID"]), counts[node]
+            if len(counts) == 1:
+                # the count of a single node, or --ntasks-per-node
+                return int(environ["SLURM_LOCALID"]), counts[0]
+    return 0, 1
+
+
+# Variables through which launchers report that they bound each rank
+_BINDING_VARS = ["SLURM_CPU_BIND_TYPE", "OMPI_MCA_hwloc_base_binding_policy"]
+
+
+def launcher_bound(environ):
+    """Whether the launcher reports that it bound the ranks to CPUs."""
+    for var in _BINDING_VARS:
+        tokens = [t for t in environ.get(var, "").replace(":", ",").split(",") if t]
+        if any(t not in ("none", "quiet", "verbose") for t in tokens):
+            return True
+    return False
+
+
+def _allowed_cpus(proc_root, pid):
+    status = _read(os.path.join(proc_root, str(pid), "status")) or ""
+    for line in status.splitlines():
+        if line.startswith("Cpus_allowed_list:"):
+            return frozenset(parse_cpulist(line.split(":", 1)[1]))
+    return None
+
+
+def siblings_bound(proc_root="/proc", pid=None):
+    """Whether the processes started by our parent have different affinities.
+
+    Launchers start all ranks of a node from one process, so differing
+    masks among its children mean that each rank was bound on its own.
+    """
+    pid = os.getpid() if pid is None else pid
+    stat = _read(os.path.join(proc_root, str(pid), "stat")) or ""
+    # the command name may contain spaces, the fields after it do not
+    fields = stat.rpartition(")")[2].split()
+    if len(fields) < 2:
+        return False
+    ppid = fields[1]
+    children = []
+    for task in glob.glob(os.path.join(proc_root, ppid, "task", "*", "children")):
+        children.extend((_read(task) or "").split())
+    masks = set(_allowed_cpus(proc_root, child) for child in children)
+    masks.discard(None)
+    return len(masks) > 1
+
+
+def plan(topology, rank, ranks, bound=False):
+    """Return ``(cores, ranks)`` for ``rank`` out of ``ranks`` on ``topology``.
+
+    ``topology`` covers the CPUs this process may use. If the launcher bound
+    the rank to them, all of them are its own; otherwise, as within a
+    cpuset shared by all ranks, they are split among the local ranks.
+    """
+    if bound:
+        return topology.layout(1)[0], 1
+    return fit(topology, ranks).layout(ranks)[rank % ranks], ranks
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        description="Pin the OpenMP threads of an Amber run to the node topology.",
+        usage="%(prog)s [options] [--] command [args...]",
+    )
+    parser.add_argument("--ranks", type=int, help="MPI ranks on this node (default: detected)")
+    parser.add_argument("--rank", type=int, help="Local rank of this process (default: detected)")
+    parser.add_argument("--smt", action="store_true", help="Run one thread per hardware thread")
+    parser.add_argument("--print", action="store_true", help="Print the layout and exit")
+    parser.add_argument("--quiet", action="store_true", help="Do not print the chosen layout")
+    parser.add_argument("--sysfs-root", default="/sys", help="Read sysfs from another tree")
+    parser.add_argument("--proc-root", default="/proc", help="Read procfs from another tree")
+    parser.add_argument("command", nargs=argparse.REMAINDER)
+    return parser
+
+
+def main(argv=None, environ=None):
+    environ = dict(os.environ if environ is None else environ)
+    args = build_parser().parse_args(argv)
+    command = args.command[1:] if args.command[:1] == ["--"] else args.command
+    if not command and not args.print:
+        build_parser().error("no command given")
+
+    rank, ranks = local_rank(environ)
+    ranks = args.ranks or ranks
+    rank = args.rank if args.rank is not None else rank
+    allowed, bound = None, False
+    if args.sysfs_root == "/sys" and hasattr(os, "sched_getaffinity"):
+        allowed = os.sched_getaffinity(0)
+        full = Topology.detect(args.sysfs_root, args.proc_root)
+        narrowed = len(allowed) < sum(len(core) for core in full.cores)
+        bound = narrowed and (launcher_bound(environ) or siblings_bound(args.proc_root))
+    topology = Topology.detect(args.sysfs_root, args.proc_root, allowed)
+    try:
+        cores, ranks = plan(topology, rank, ranks, bound)
+    except ValueError as e:
+        # oversubscribed: leave the placement to the operating system
+        message = "amber-launch: {0}, running unpinned".format(e)
+        if args.print:
+            print(message)
+            return 0
+        if not args.quiet:
+            sys.stderr.write(message + "\n")
+        os.execvpe(command[0], command, environ)
+    note = ""
+    if bound:
+        note = " (bound by the launcher)"
+    elif ranks > len(topology.cores):
+        note = " (one per hardware thread)"
+    summary = "amber-launch: {0} cores in {1} NUMA domains, {2} ranks{3}".format(
+        len(topology.cores), len(topology.domains), ranks, note
+    )
+
+    if args.print:
+        print(summary)
+        for i, assigned in enumerate(fit(topology, ranks).layout(ranks)):
+            print("rank {0}: {1}".format(i, omp_environment(assigned, args.smt)))
+        return 0
+
+    env = omp_environment(cores, args.smt)
+    if not args.quiet:
+        sys.stderr.write(
+            "{0}; rank {1}: OMP_NUM_THREADS={OMP_NUM_THREADS} OMP_PLACES={OMP_PLACES}\n".format(
+                summary, rank, **env
+            )
+        )
+    environ.update(env)
+    os.execvpe(command[0], command, environ)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""Compare the cmake.log handling of configure_cmake.py with the old approach.
+
+Two steps of a configure run are timed, each the old way and with
+``CMakeLog``:
+
+  write  the configure messages: reopening cmake.log for every line, as the
+         former printSave did, against the buffered log kept open
+  tee    the cmake output: an external ``tee -a cmake.log`` echoed back line
+         by line through Python, against ``CMakeLog.tee`` on the pipe
+
+cmake is replaced by a Python process printing ``--lines`` lines. stdout
+is discarded while timing, and each case reports the best of ``--repeat``
+runs.
+
+    python3 bench_cmake_log.py --lines 20000 --repeat 5
+"""
+
+import argparse
+import contextlib
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import configure_cmake  # noqa: E402
+
+
+def _print_save(text, first=False):
+    """The former configure_cmake.printSave."""
+    with open("cmake.log", "w" if first else "a") as f:
+        f.write(text + "\n")
+    print(text)
+
+
+def _write_reopen(lines):
+    for i in range(lines):
+        _print_save("-- Checking option {0} ........ yes".format(i), first=i == 0)
+
+
+def _write_buffered(lines):
+    log = configure_cmake.CMakeLog("cmake.log")
+    for i in range(lines):
+        log.write("-- Checking option {0} ........ yes".format(i))
+    log.close()
+
+
+def _generator(lines):
+    return [
+        sys.executable,
+        "-c",
+        "for i in range({0}): print('-- Looking for feature', i, '- found')".format(lines),
+    ]
+
+
+def _tee_external(lines):
+    cmake = subprocess.Popen(_generator(lines), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    save = subprocess.Popen(
+        ["tee", "-a", "cmake.log"],
+        stdin=cmake.stdout,
+        stdout=subprocess.PIPE,
+        universal_newlines=True,
+    )
+    for line in save.stdout:
+        print(line, end="")
+    cmake.stdout.close()
+    save.communicate()
+    cmake.wait()
+
+
+def _tee_in_process(lines):
+    log = configure_cmake.CMakeLog("cmake.log", mode="a")
+    configure_cmake.run_cmake(_generator(lines), log)
+    log.close()
+
+
+_cases = [
+    ("write", "reopen per line", _write_reopen),
+    ("write", "CMakeLog", _write_buffered),
+    ("tee", "external tee", _tee_external),
+    ("tee", "CMakeLog.tee", _tee_in_process),
+]
+
+
+def _best_time(function, lines, repeat):
+    best = None
+    for _ in range(repeat):
+        if os.path.exists("cmake.log"):
+            os.remove("cmake.log")
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+            function(lines)
+            seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--lines", type=int, default=20000, help="Lines per run")
+    parser.add_argument("--repeat", type=int, default=5, help="Runs per case")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="bench-cmake-log-") as work:
+        cwd = os.getcwd()
+        os.chdir(work)
+        try:
+            for step, label, function in _cases:
+                seconds = _best_time(function, args.lines, args.repeat)
+                print("{0:<6} {1:<16} {2:8.4f} s".format(step, label, seconds))
+        finally:
+            os.chdir(cwd)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,131 @@
+#!/usr/bin/env spack-python
+
+"""Measure staging of the AmberTools resource into the Amber source root.
+
+A synthetic resource tree of each requested size is staged the way the
+package used to, with a copy over the source root followed by removing the
+resource directory, and with ``_merge_tree`` from the Amber package. The
+wall time and the bytes written to storage are reported for both, so it can
+be checked that merging does not scale with the size of the tarball.
+
+    spack python bench_stage.py --sizes 256M,1G,4G --dir /path/on/build/fs
+
+Run it on the filesystem that holds the build stage: bytes written are read
+from /proc/self/io and are not counted on tmpfs.
+"""
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# size of the files in the synthetic tree, and files per directory
+_file_size = 256 << 10
+_files_per_dir = 32
+
+
+def _parse_size(text):
+    """Parse a size such as ``512M`` or ``4G`` into bytes."""
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    text = text.strip().upper()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def _load_package():
+    """Return the module of the Amber package from the Spack repositories."""
+    try:
+        import spack.repo
+    except ImportError:
+        sys.exit("bench_stage.py: run this script with `spack python`")
+    return sys.modules[spack.repo.path.get_pkg_class("amber").__module__]
+
+
+def _make_tree(root, size):
+    """Write an AmberTools-like tree of ``size`` bytes under ``root``."""
+    chunk = os.urandom(_file_size)
+    for i in range(max(1, size // _file_size)):
+        directory = os.path.join(root, "AmberTools", "src", "prog{0}".format(i // _files_per_dir))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(os.path.join(directory, "file{0}.F90".format(i)), "wb") as f:
+            f.write(chunk)
+    # a directory shared with the source root, merged rather than renamed
+    os.makedirs(os.path.join(root, "cmake"))
+    with open(os.path.join(root, "cmake", "AmberToolsConfig.cmake"), "w") as f:
+        f.write("# AmberTools\n")
+
+
+def _copy(src, dest):
+    shutil.copytree(src, dest, symlinks=True, dirs_exist_ok=True)
+    shutil.rmtree(src)
+
+
+def _measure(package, method, size, workdir):
+    """Stage a fresh tree of ``size`` bytes with ``method``."""
+    root = tempfile.mkdtemp(prefix="bench-stage-", dir=workdir)
+    try:
+        src = os.path.join(root, "ambertools_tmpdir")
+        dest = os.path.join(root, "spack-src")
+        _make_tree(src, size)
+        os.makedirs(os.path.join(dest, "cmake"))
+        os.sync()
+
+        written = package._bytes_written()
+        start = time.perf_counter()
+        if method == "merge":
+            package._merge_tree(src, dest)
+            shutil.rmtree(src)
+        else:
+            _copy(src, dest)
+        os.sync()
+        seconds = time.perf_counter() - start
+        if written is not None:
+            written = package._bytes_written() - written
+        return {
+            "method": method,
+            "size": size,
+            "wall_seconds": round(seconds, 3),
+            "bytes_written": written,
+        }
+    finally:
+        shutil.rmtree(root)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--sizes", default="256M,1G", help="Comma-separated tree sizes (default: 256M,1G)"
+    )
+    parser.add_argument("--dir", default=os.getcwd(), help="Directory to stage in")
+    parser.add_argument("--json", help="Also write the results to this file")
+    args = parser.parse_args(argv)
+
+    package = _load_package()
+    results = []
+    for size in [_parse_size(s) for s in args.sizes.split(",")]:
+        for method in ("copy", "merge"):
+            result = _measure(package, method, size, args.dir)
+            results.append(result)
+            print(
+                "{0:>10} {1:<6} {2:8.3f} s {3:>10} written".format(
+                    package._human_size(size),
+                    method,
+                    result["wall_seconds"],
+                    "n/a"
+                    if result["bytes_written"] is None
+                    else package._human_size(result["bytes_written"]),
+                )
+            )
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,229 +2,386 @@
 
 """
 A replacement script for the legacy configure that calls cmake in the build/ directory
+
+The script can also be imported.  parse_args() turns a list of options into
+a namespace, configure() resolves it into the cmake command line (a list of
+arguments) and run_cmake()/clean_sources() carry out the remaining steps, so
+several configurations can be prepared in a single process.
 """
 
 AMBER_VERSION = '22'
 
 import argparse
+import hashlib
 import subprocess
 import os
 import sys
 import datetime
 import platform
+import shlex
+import shutil
 import stat
+import threading
 
-parser = argparse.ArgumentParser(description='Configure Amber(Tools) using cmake.'
-    '  Answers to common questions are here: \n'
-    '  https://ambermd.org/pmwiki/pmwiki.php/Main/CMake-Quick-Start \n',
-                                 usage='%(prog)s [-h] [--source SOURCE] [--prefix PREFIX] [...]')
+def build_parser():
+    parser = argparse.ArgumentParser(description='Configure Amber(Tools) using cmake.'
+        '  Answers to common questions are here: \n'
+        '  https://ambermd.org/pmwiki/pmwiki.php/Main/CMake-Quick-Start \n',
+                                     usage='%(prog)s [-h] [--source SOURCE] [--prefix PREFIX] [...]')
 
-section = parser.add_argument_group(title='Installation location')
-section.add_argument('--prefix',nargs=1,required=False,
-                    help='Location of the install directory. Defaults to ./../../amber'+AMBER_VERSION)
+    section = parser.add_argument_group(title='Installation location')
+    section.add_argument('--prefix',nargs=1,required=False,
+                        help='Location of the install directory. Defaults to ./../../amber'+AMBER_VERSION)
 
-section = parser.add_argument_group(title='Source location',
-                                    description="""
+    section = parser.add_argument_group(title='Source location',
+                                        description="""
 The Amber(Tools) source is set by the current folder tree or can be set with the --source optional argument.
 """)
-section.add_argument('--source',nargs=1,
-                    help="Location of the source directory. Defaults to current source tree")
-
-section = parser.add_argument_group(title='Compiler and numerical library selection')
-section.add_argument('--compiler',nargs=1,
-                    choices=["GNU","PGI","INTEL","CRAY","MSVC","CLANG","AUTO","MANUAL",
-                             "gnu","pgi","intel","cray","msvc","clang","auto","manual"],
-                    help="specify which compiler to use (default is GNU)")
-section.add_argument('--blas',nargs=1,dest='blas',
-                    choices=['All','OpenBLAS','Goto','ACML','Apple','NAS','Generic'],
-                    help='which version of BLAS and LAPACK to look for (default: All)')
-
-section = parser.add_argument_group(title='Acceleration related arguments')
-section.add_argument('--mpi',action="store_true",
-                    help='Turns on MPI parallelization')
-section.add_argument('--cuda',action="store_true",
-                    help='Turns on CUDA-accelerated version of Amber(Tools)')
-section.add_argument('--openmp',action="store_true",
-                    help='Turns on OpenMP parallelization')
-
-section = parser.add_argument_group(title='Optional builds')
-section.add_argument('--quick',action="store_true",
-                    help='build quick ab initio qm code')
-section.add_argument('--reaxff',action="store_true",
-                    help='build reaxff puremd code')
-section.add_argument('--no-gui','--noX11',action="store_true",dest='noX11',
-                    help='Do not build GUI parts of leap (default: build)')
-section.add_argument('--disable-tools',nargs=1,dest='disable_tools',
-                    help="Comma separated list of Amber Tools not to be built")
-
-section = parser.add_argument_group(title='Tests, examples, and benchmarks')
-group = section.add_mutually_exclusive_group()
-group.add_argument('--install-tests',action="store_const",dest='install_tests',const=True,
-                    help='Install tests, examples, and benchmarks (default)')
-group.add_argument('--no-install-tests',action="store_const",dest='install_tests',const=False,
-                    help='')
-
-section = parser.add_argument_group(title='Python related stuff')
-group = section.add_mutually_exclusive_group()
-group.add_argument('--python',dest='python',action="store_const",const=True,
-                    help='Build related python packages (default)')
-group.add_argument('--no-python',dest='python',action="store_const",const=False,
-                    help='')
-
-section.add_argument('--with-python',nargs=1,dest='python_exe',
-                    help='Location of the python executable (default: path to system python, if found)')
-
-group = section.add_mutually_exclusive_group()
-group.add_argument('--miniconda',action="store_const",dest="miniconda",const=True,
-                   help='Download and use the Miniconda python environment (default)')
-group.add_argument('--no-miniconda',action="store_const",dest="miniconda",const=False,
-                   help='')
-
-section = parser.add_argument_group(title='Handling of internal and external libraries')
-section.add_argument('--force-internal-libs',nargs=1,dest='internal_libs',
-                    help="Comma separated list of 3rd party libraries to be built from Amber's bundled version (list printed at the end of the cmake build report)")
-section.add_argument('--force-external-libs',nargs=1,dest='external_libs',
-                    help="Comma separated list of 3rd party libraries to be used from the system (list printed at the end of the cmake build report)")
-section.add_argument('--force-disable-libs',nargs=1,dest='disable_libs',
-                    help="Comma separated list of 3rd party libraries to be disabled (list printed at the end of the cmake build report)")
-
-section = parser.add_argument_group(title='Updates')
-group = section.add_mutually_exclusive_group()
-group.add_argument('--check-updates',action="store_const",dest='check_updates',const=True,
-                    help="Check for new patches from the Amber update server (default)")
-group.add_argument('--no-check-updates',action="store_const",dest='check_updates',const=False,
-                    help="")
-
-group = section.add_mutually_exclusive_group()
-group.add_argument('--apply-updates',action="store_const",dest='apply_updates',const=True,
-                    help="")
-group.add_argument('--no-apply-updates',action="store_const",dest='apply_updates',const=False,
-                    help="Do not apply available updates for Amber and AmberTools (default)")
-
-section = parser.add_argument_group(title='Miscellaneous')
-group = section.add_mutually_exclusive_group()
-group.add_argument('--color-message',action="store_const",dest='color',const=True,
-                   help="output colored cmake messages (default)")
-group.add_argument('--no-color-message',action="store_const",dest='color',const=False,
-                   help="")
-group.add_argument('-bw',action="store_const",dest='color',const=False,
-                   help="Black and White, ie, disable cmake's output coloring")
-
-section.add_argument('--dry-run',action="store_const",dest='dry_run',const=True,
-                     help="emit cmake instructions but do not run them")
-section.add_argument('--save',nargs='?',const='run_cmake',default=False,
-                     help='save the cmake command in a file (default: run_cmake)')
-
-parser.set_defaults(compiler=['CLANG'] if platform.system() == "Darwin" else ['GNU'],
-                    python=True,
-                    miniconda=True,
-                    check_updates=True,
-                    apply_updates=False,
-                    color=True,
-                    dry_run=False,
-                    install_tests=True)
-
-args = parser.parse_args()
-
-def printSave(aString,first=False):
-    # save to cmake.log + print
-    if first:
-        with open('cmake.log','w') as f:
-            f.write(aString+'\n')
-    else:
-        with open('cmake.log','a') as f:
-            f.write(aString+'\n')
-    print(aString)
-
-
-def action_bool(key_bool,key_str,comment):
+    section.add_argument('--source',nargs=1,
+                        help="Location of the source directory. Defaults to current source tree")
+
+    section = parser.add_argument_group(title='Compiler and numerical library selection')
+    section.add_argument('--compiler',nargs=1,
+                        choices=["GNU","PGI","INTEL","CRAY","MSVC","CLANG","AUTO","MANUAL",
+                                 "gnu","pgi","intel","cray","msvc","clang","auto","manual"],
+                        help="specify which compiler to use (default is GNU)")
+    section.add_argument('--blas',nargs=1,dest='blas',
+                        choices=['All','OpenBLAS','Goto','ACML','Apple','NAS','Generic'],
+                        help='which version of BLAS and LAPACK to look for (default: All)')
+
+    section = parser.add_argument_group(title='Acceleration related arguments')
+    section.add_argument('--mpi',action="store_true",
+                        help='Turns on MPI parallelization')
+    section.add_argument('--cuda',action="store_true",
+                        help='Turns on CUDA-accelerated version of Amber(Tools)')
+    section.add_argument('--openmp',action="store_true",
+                        help='Turns on OpenMP parallelization')
+
+    section = parser.add_argument_group(title='Optional builds')
+    section.add_argument('--quick',action="store_true",
+                        help='build quick ab initio qm code')
+    section.add_argument('--reaxff',action="store_true",
+                        help='build reaxff puremd code')
+    section.add_argument('--no-gui','--noX11',action="store_true",dest='noX11',
+                        help='Do not build GUI parts of leap (default: build)')
+    section.add_argument('--disable-tools',nargs=1,dest='disable_tools',
+                        help="Comma separated list of Amber Tools not to be built")
+
+    section = parser.add_argument_group(title='Tests, examples, and benchmarks')
+    group = section.add_mutually_exclusive_group()
+    group.add_argument('--install-tests',action="store_const",dest='install_tests',const=True,
+                        help='Install tests, examples, and benchmarks (default)')
+    group.add_argument('--no-install-tests',action="store_const",dest='install_tests',const=False,
+                        help='')
+
+    section = parser.add_argument_group(title='Python related stuff')
+    group = section.add_mutually_exclusive_group()
+    group.add_argument('--python',dest='python',action="store_const",const=True,
+                        help='Build related python packages (default)')
+    group.add_argument('--no-python',dest='python',action="store_const",const=False,
+                        help='')
+
+    section.add_argument('--with-python',nargs=1,dest='python_exe',
+                        help='Location of the python executable (default: path to system python, if found)')
+
+    group = section.add_mutually_exclusive_group()
+    group.add_argument('--miniconda',action="store_const",dest="miniconda",const=True,
+                       help='Download and use the Miniconda python environment (default)')
+    group.add_argument('--no-miniconda',action="store_const",dest="miniconda",const=False,
+                       help='')
+
+    section = parser.add_argument_group(title='Handling of internal and external libraries')
+    section.add_argument('--force-internal-libs',nargs=1,dest='internal_libs',
+                        help="Comma separated list of 3rd party libraries to be built from Amber's bundled version (list printed at the end of the cmake build report)")
+    section.add_argument('--force-external-libs',nargs=1,dest='external_libs',
+                        help="Comma separated list of 3rd party libraries to be used from the system (list printed at the end of the cmake build report)")
+    section.add_argument('--force-disable-libs',nargs=1,dest='disable_libs',
+                        help="Comma separated list of 3rd party libraries to be disabled (list printed at the end of the cmake build report)")
+
+    section = parser.add_argument_group(title='Updates')
+    group = section.add_mutually_exclusive_group()
+    group.add_argument('--check-updates',action="store_const",dest='check_updates',const=True,
+                        help="Check for new patches from the Amber update server (default)")
+    group.add_argument('--no-check-updates',action="store_const",dest='check_updates',const=False,
+                        help="")
+
+    group = section.add_mutually_exclusive_group()
+    group.add_argument('--apply-updates',action="store_const",dest='apply_updates',const=True,
+                        help="")
+    group.add_argument('--no-apply-updates',action="store_const",dest='apply_updates',const=False,
+                        help="Do not apply available updates for Amber and AmberTools (default)")
+
+    section = parser.add_argument_group(title='Build tool')
+    section.add_argument('--generator',nargs=1,
+                        choices=['Unix Makefiles','Ninja'],
+                        help='cmake generator used for the build (default: Unix Makefiles)')
+    section.add_argument('--compiler-launcher',nargs=1,dest='compiler_launcher',
+                        help='program that wraps every compiler call, e.g. ccache')
+    section.add_argument('--unity-build',action="store_true",dest='unity_build',
+                        help='combine C and C++ sources into unity translation units')
+    section.add_argument('--unity-build-batch-size',nargs=1,dest='unity_batch_size',
+                        help='number of sources per unity translation unit (cmake default: 8)')
+
+    section = parser.add_argument_group(title='Miscellaneous')
+    group = section.add_mutually_exclusive_group()
+    group.add_argument('--color-message',action="store_const",dest='color',const=True,
+                       help="output colored cmake messages (default)")
+    group.add_argument('--no-color-message',action="store_const",dest='color',const=False,
+                       help="")
+    group.add_argument('-bw',action="store_const",dest='color',const=False,
+                       help="Black and White, ie, disable cmake's output coloring")
+
+    section.add_argument('--dry-run',action="store_const",dest='dry_run',const=True,
+                         help="emit cmake instructions but do not run them")
+    section.add_argument('--force',action="store_true",
+                         help="rerun cmake and the source cleanup even if the configuration is unchanged")
+    section.add_argument('--log-timestamps',action="store_true",dest='log_timestamps',
+                         help="prefix each line of cmake.log with a timestamp")
+    section.add_argument('--save',nargs='?',const='run_cmake',default=False,
+                         help='save the cmake command in a file (default: run_cmake)')
+
+    parser.set_defaults(compiler=['CLANG'] if platform.system() == "Darwin" else ['GNU'],
+                        python=True,
+                        miniconda=True,
+                        check_updates=True,
+                        apply_updates=False,
+                        color=True,
+                        dry_run=False,
+                        install_tests=True)
+    return parser
+
+
+def parse_args(argv=None):
+    return build_parser().parse_args(argv)
+
+
+class CMakeLog(object):
+    """cmake.log writer that also echoes every line to stdout.
+
+    The log stays open and buffered for the whole run instead of being
+    reopened for each line.
+    """
+    def __init__(self,filename,timestamps=False,mode='w'):
+        self.file=open(filename,mode,buffering=1<<16)
+        self.timestamps=timestamps
+        self.lock=threading.Lock()
+
+    def write(self,aString):
+        with self.lock:
+            for line in aString.split('\n'):
+                self.file.write(self.stamp()+line+'\n')
+            print(aString)
+
+    def tee(self,stream):
+        # copy the lines of a text pipe to both the log and stdout; several
+        # pipes may be copied at once from different threads
+        for line in stream:
+            with self.lock:
+                self.file.write(self.stamp()+line)
+                sys.stdout.write(line)
+
+    def stamp(self):
+        if not self.timestamps:
+            return ''
+        return datetime.datetime.now().strftime('[%H:%M:%S.%f] ')
+
+    def flush(self):
+        self.file.flush()
+        sys.stdout.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class NullLog(object):
+    """Stand-in for CMakeLog when configure() is called without a log."""
+    def write(self,aString):
+        pass
+
+
+class ConfigureError(Exception):
+    pass
+
+
+def action_bool(key_bool,key_str,comment,log):
     comment_formatted=comment+' '+'.'*40
     comment_formatted=comment_formatted[:max(40,len(comment)+3)]
     if key_bool:
-       printSave("{} yes".format(comment_formatted))
+       log.write("{} yes".format(comment_formatted))
        return "-D%s=TRUE" % (key_str)
     else:
-       printSave("{} no".format(comment_formatted))
+       log.write("{} no".format(comment_formatted))
        return "-D%s=FALSE" % (key_str)
 
-def action_string(key,cmake_str,comment):
+def action_string(key,cmake_str,comment,log):
     comment_formatted=comment+' '+'.'*40
     comment_formatted=comment_formatted[:max(40,len(comment)+3)]
-    printSave("{} {}".format(comment_formatted,key[0]))
+    log.write("{} {}".format(comment_formatted,key[0]))
     # this seems innocuous but unnecessary wrt AMBERHOME with spaces or '\ ' in it.
     #return "-D%s='%s'" % (cmake_str,key[0])
     return "-D%s=%s" % (cmake_str,key[0])
 
 
-printSave('Starting configure_cmake.py on {}\n'.format(datetime.datetime.now().strftime('%c')),first=True)
-# script meant to run within build folder. location of the source depends on current tree
-if args.source is None:
-    source_path = os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(__file__)),os.pardir))
-    printSave('Setting SOURCE path automatically to ... '+source_path)
-    args.source=[source_path]
-
-if args.prefix is None:
-    install_path = os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(__file__)),os.pardir))
-    install_path = os.path.normpath(os.path.join(os.path.abspath(install_path),os.pardir,'amber'+AMBER_VERSION))
-    printSave('Setting INSTALL path PREFIX automatically to ... '+install_path)
-    args.prefix=[install_path]
-else:
-    # reformat prefix to get absolute path
-    args.prefix=[os.path.abspath(args.prefix[0])]
-
-mystr=['cmake',args.source[0]]
-action_string(args.source,'','Amber(Tools) source directory')
-if not os.path.exists(os.path.join(args.source[0],'CMakeLists.txt')):
-    printSave('This directory is not a Amber source tree. CMakeLists.txt is missing...')
-    sys.exit(1)
-mystr += [action_string(args.prefix,'CMAKE_INSTALL_PREFIX','install directory')]
-
-if args.compiler is not None:
-    args.compiler[0] = args.compiler[0].upper()
-    mystr += [action_string(args.compiler,'COMPILER','compiler')]
-
-mystr += [action_bool(args.mpi,'MPI','enable MPI parallelization')]
-mystr += [action_bool(args.cuda,'CUDA','enable CUDA acceleration')]
-mystr += [action_bool(args.openmp,'OPENMP','enable OpenMP parallelization')]
-
-mystr += [action_bool(not args.noX11,'BUILD_GUI','build GUI')]
-
-mystr += [action_bool(args.install_tests,'INSTALL_TESTS','install tests')]
-
-if args.quick: mystr += [action_bool(args.quick,'BUILD_QUICK','enable QUICK')]
-if args.reaxff: mystr += [action_bool(args.reaxff,'BUILD_REAXFF_PUREMD','enable REAXFF_PUREMD')]
-
-# Python related stuff
-mystr += [action_bool(args.python,'BUILD_PYTHON','build python programs')]
-if not args.python:
-    # don't install miniconda if build_python is False
-    args.miniconda=False
-else:
-    if args.python_exe is not None: mystr += [action_string(args.python_exe,'PYTHON_EXECUTABLE','python executable location')]
-if args.python_exe is None:
-    mystr += [action_bool(args.miniconda,'DOWNLOAD_MINICONDA','download miniconda')]
-
-# libraries
-if platform.system() == "Darwin" and args.blas is None:
-    mystr += [action_string("Apple",'BLA_VENDOR','blas/lapack vendor')]
-elif args.blas is not None:
-    mystr += [action_string(args.blas,'BLA_VENDOR','blas/lapack vendor')]
-if args.internal_libs is not None: mystr += [action_string(args.internal_libs,'FORCE_INTERNAL_LIBS','force internal library building for')]
-if args.external_libs is not None: mystr += [action_string(args.external_libs,'FORCE_EXTERNAL_LIBS','force external library building for')]
-if args.disable_libs is not None: mystr += [action_string(args.disable_libs,'FORCE_DISABLE_LIBS','disable library building for')]
-if args.disable_tools is not None: mystr += [action_string(args.disable_tools,'DISABLE_TOOLS','disable Amber Tools')]
-
-# Updates
-mystr += [action_bool(args.check_updates,'CHECK_UPDATES','check for available updates')]
-mystr += [action_bool(args.apply_updates,'APPLY_UPDATES','apply available updates')]
-
-# Miscellaneous
-mystr += [action_bool(args.color,'COLOR_CMAKE_MESSAGES','cmake color messages')]
-
-# Begin long if
-if args.save:
-    action_string([args.save],'','Saving cmake instructions')
-    with open(args.save,'w') as f:
+def action_flag(key,flag,comment,log):
+    comment_formatted=comment+' '+'.'*40
+    comment_formatted=comment_formatted[:max(40,len(comment)+3)]
+    log.write("{} {}".format(comment_formatted,key[0]))
+    return flag+key[0]
+
+
+def configure(args,log=None):
+    """Resolve the parsed options into the cmake command line.
+
+    Returns the command as a list of arguments, starting with 'cmake'.  The
+    configuration report is written to log.  args is updated in place with
+    the resolved source and prefix.  Raises ConfigureError if the source is
+    not an Amber tree.
+    """
+    if log is None:
+        log=NullLog()
+
+    # script meant to run within build folder. location of the source depends on current tree
+    if args.source is None:
+        source_path = os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(__file__)),os.pardir))
+        log.write('Setting SOURCE path automatically to ... '+source_path)
+        args.source=[source_path]
+
+    if args.prefix is None:
+        install_path = os.path.normpath(os.path.join(os.path.abspath(os.path.dirname(__file__)),os.pardir))
+        install_path = os.path.normpath(os.path.join(os.path.abspath(install_path),os.pardir,'amber'+AMBER_VERSION))
+        log.write('Setting INSTALL path PREFIX automatically to ... '+install_path)
+        args.prefix=[install_path]
+    else:
+        # reformat prefix to get absolute path
+        args.prefix=[os.path.abspath(args.prefix[0])]
+
+    mystr=['cmake',args.source[0]]
+    action_string(args.source,'','Amber(Tools) source directory',log)
+    if not os.path.exists(os.path.join(args.source[0],'CMakeLists.txt')):
+        raise ConfigureError('This directory is not a Amber source tree. CMakeLists.txt is missing...')
+    mystr += [action_string(args.prefix,'CMAKE_INSTALL_PREFIX','install directory',log)]
+
+    if args.compiler is not None:
+        args.compiler[0] = args.compiler[0].upper()
+        mystr += [action_string(args.compiler,'COMPILER','compiler',log)]
+
+    mystr += [action_bool(args.mpi,'MPI','enable MPI parallelization',log)]
+    mystr += [action_bool(args.cuda,'CUDA','enable CUDA acceleration',log)]
+    mystr += [action_bool(args.openmp,'OPENMP','enable OpenMP parallelization',log)]
+
+    mystr += [action_bool(not args.noX11,'BUILD_GUI','build GUI',log)]
+
+    mystr += [action_bool(args.install_tests,'INSTALL_TESTS','install tests',log)]
+
+    if args.quick: mystr += [action_bool(args.quick,'BUILD_QUICK','enable QUICK',log)]
+    if args.reaxff: mystr += [action_bool(args.reaxff,'BUILD_REAXFF_PUREMD','enable REAXFF_PUREMD',log)]
+
+    # Python related stuff
+    mystr += [action_bool(args.python,'BUILD_PYTHON','build python programs',log)]
+    if not args.python:
+        # don't install miniconda if build_python is False
+        args.miniconda=False
+    else:
+        if args.python_exe is not None: mystr += [action_string(args.python_exe,'PYTHON_EXECUTABLE','python executable location',log)]
+    if args.python_exe is None:
+        mystr += [action_bool(args.miniconda,'DOWNLOAD_MINICONDA','download miniconda',log)]
+
+    # libraries
+    if platform.system() == "Darwin" and args.blas is None:
+        mystr += [action_string("Apple",'BLA_VENDOR','blas/lapack vendor',log)]
+    elif args.blas is not None:
+        mystr += [action_string(args.blas,'BLA_VENDOR','blas/lapack vendor',log)]
+    if args.internal_libs is not None: mystr += [action_string(args.internal_libs,'FORCE_INTERNAL_LIBS','force internal library building for',log)]
+    if args.external_libs is not None: mystr += [action_string(args.external_libs,'FORCE_EXTERNAL_LIBS','force external library building for',log)]
+    if args.disable_libs is not None: mystr += [action_string(args.disable_libs,'FORCE_DISABLE_LIBS','disable library building for',log)]
+    if args.disable_tools is not None: mystr += [action_string(args.disable_tools,'DISABLE_TOOLS','disable Amber Tools',log)]
+
+    # Updates
+    mystr += [action_bool(args.check_updates,'CHECK_UPDATES','check for available updates',log)]
+    mystr += [action_bool(args.apply_updates,'APPLY_UPDATES','apply available updates',log)]
+
+    # Build tool
+    if args.generator is not None: mystr += [action_flag(args.generator,'-G','cmake generator',log)]
+    if args.compiler_launcher is not None:
+        languages = ['C','CXX','Fortran']
+        if args.cuda: languages.append('CUDA')
+        for lang in languages:
+            mystr += [action_string(args.compiler_launcher,'CMAKE_%s_COMPILER_LAUNCHER' % lang,'%s compiler launcher' % lang,log)]
+    if args.unity_build: mystr += [action_bool(args.unity_build,'CMAKE_UNITY_BUILD','unity build',log)]
+    if args.unity_batch_size is not None: mystr += [action_string(args.unity_batch_size,'CMAKE_UNITY_BUILD_BATCH_SIZE','unity build batch size',log)]
+
+    # Miscellaneous
+    mystr += [action_bool(args.color,'COLOR_CMAKE_MESSAGES','cmake color messages',log)]
+
+    return mystr
+
+
+# name of the file that records the configuration of a build directory
+FINGERPRINT_FILE = '.configure_fingerprint'
+
+# files, relative to the source tree, whose content decides the cmake result
+FINGERPRINT_INPUTS = ['CMakeLists.txt',
+                      os.path.join('src','CMakeLists.txt'),
+                      os.path.join('AmberTools','src','CMakeLists.txt'),
+                      'cmake']
+
+# environment variables that change what cmake detects
+FINGERPRINT_ENV = ['CC','CXX','FC','F77','CFLAGS','CXXFLAGS','FFLAGS','LDFLAGS',
+                   'CMAKE_PREFIX_PATH','CUDA_HOME']
+
+
+def fingerprint(mystr,source):
+    """Hash the cmake command line together with the cmake inputs of the source."""
+    h = hashlib.sha256()
+    h.update('\0'.join(mystr).encode())
+    for name in FINGERPRINT_ENV:
+        h.update('\0{}={}'.format(name,os.environ.get(name,'')).encode())
+    for entry in FINGERPRINT_INPUTS:
+        path = os.path.join(source,entry)
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root,f) for root,dirs,names in os.walk(path) for f in names)
+        for filename in files:
+            if not os.path.isfile(filename):
+                continue
+            h.update('\0{}\0'.format(os.path.relpath(filename,source)).encode())
+            with open(filename,'rb') as f:
+                h.update(f.read())
+    return h.hexdigest()
+
+
+def is_configured(build_dir,fp):
+    """True if build_dir was last configured successfully with fingerprint fp."""
+    if not os.path.exists(os.path.join(build_dir,'CMakeCache.txt')):
+        return False
+    try:
+        with open(os.path.join(build_dir,FINGERPRINT_FILE)) as f:
+            return f.read().strip() == fp
+    except (IOError,OSError):
+        return False
+
+
+def record_fingerprint(build_dir,fp):
+    """Record fp for build_dir, or forget the previous one if fp is None."""
+    filename = os.path.join(build_dir,FINGERPRINT_FILE)
+    if fp is None:
+        if os.path.exists(filename):
+            os.remove(filename)
+        return
+    with open(filename,'w') as f:
+        f.write(fp+'\n')
+
+
+def build_command(args):
+    """Command that builds and installs a tree configured with args."""
+    if args.generator is not None and args.generator[0] == 'Ninja':
+        return 'ninja install'
+    return 'make install'
+
+
+def save_script(filename,mystr,prefix,build='make install'):
+    """Write the cmake command to an executable shell script."""
+    with open(filename,'w') as f:
         f.write("""#!/bin/bash
 
 #  cmake instructions from running configure_cmake.py
@@ -250,34 +407,108 @@ fi
 echo ""
 echo "If the cmake build report looks OK, you should now do the following:"
 echo ""
-echo "    make install"
+echo "    {build}"
 echo "    source {prefix}/amber.sh"
 echo ""
 echo "Consider adding the last line to your login startup script, e.g. ~/.bashrc"
 echo ""
-""".format(cmake=" ".join(mystr),
+""".format(cmake=" ".join(shlex.quote(a) for a in mystr),
            amber_version=AMBER_VERSION,
-           save=args.save,
-           prefix=args.prefix[0]))
-    if os.path.exists(args.save): os.chmod(args.save,0o755)
-# End long if
-
-
-# echo cmake command, then apply
-printSave("\nRunning cmake command:")
-printSave(" ".join(mystr)+'\n')
-
-if not args.dry_run:
-    # run cmake and save output into cmake.log
-    cmake = subprocess.Popen(mystr,stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
-    save = subprocess.Popen(['tee','-a','cmake.log'],stdin=cmake.stdout,stdout=subprocess.PIPE,universal_newlines=True)
-    for line in save.stdout:
-        print(line,end='')
+           save=filename,
+           build=build,
+           prefix=prefix))
+    if os.path.exists(filename): os.chmod(filename,0o755)
+
+
+def run_cmake(mystr,log,cwd=None):
+    """Run cmake, saving its output into the log.  Returns the exit code."""
+    cmake = subprocess.Popen(mystr,cwd=cwd,stdout=subprocess.PIPE,stderr=subprocess.STDOUT,universal_newlines=True)
+    log.tee(cmake.stdout)
     cmake.stdout.close()
-    output=save.communicate()[0]
-    # clean source directories just to be safe; see issue 207.
-    printSave("\nCleaning source directories.")
-    os.system('cp config.h ../src; cd ../src; make silentclean')
-    os.system('cp config.h ../AmberTools/src; cd ../AmberTools/src; make silentclean')
-    sys.exit(cmake.poll())
+    return cmake.wait()
+
 
+# extensions of the files left in a source tree by a previous build
+BUILD_ARTIFACTS = ('.o','.a','.mod')
+
+
+def has_build_artifacts(tree):
+    for root,dirs,names in os.walk(tree):
+        for name in names:
+            if name.endswith(BUILD_ARTIFACTS):
+                return True
+    return False
+
+
+def clean_sources(source,build_dir,log):
+    """Clean the legacy source directories using the config.h of build_dir.
+
+    Both trees are cleaned at the same time and their output goes to the
+    log.  Trees without build artifacts are skipped.  Returns 0 on success
+    or the exit code of the first failed cleanup.
+    """
+    # clean source directories just to be safe; see issue 207.
+    log.write("\nCleaning source directories.")
+    config = os.path.join(os.path.abspath(build_dir),'config.h')
+    cleanups = []
+    for tree in ('src',os.path.join('AmberTools','src')):
+        tree = os.path.join(source,tree)
+        if not os.path.isdir(tree) or not has_build_artifacts(tree):
+            log.write('Nothing to clean in '+tree)
+            continue
+        if os.path.exists(config):
+            shutil.copy(config,tree)
+        make = subprocess.Popen(['make','silentclean'],cwd=tree,stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT,universal_newlines=True)
+        reader = threading.Thread(target=log.tee,args=(make.stdout,))
+        reader.start()
+        cleanups.append((tree,make,reader))
+
+    returncode = 0
+    for tree,make,reader in cleanups:
+        reader.join()
+        make.stdout.close()
+        if make.wait() != 0:
+            log.write('make silentclean failed in {} with exit code {}'.format(tree,make.returncode))
+            returncode = returncode or make.returncode
+    log.flush()
+    return returncode
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    log = CMakeLog('cmake.log',timestamps=args.log_timestamps)
+    log.write('Starting configure_cmake.py on {}\n'.format(datetime.datetime.now().strftime('%c')))
+    try:
+        mystr = configure(args,log)
+    except ConfigureError as e:
+        log.write(str(e))
+        log.close()
+        return 1
+
+    if args.save:
+        action_string([args.save],'','Saving cmake instructions',log)
+        save_script(args.save,mystr,args.prefix[0],build_command(args))
+
+    # echo cmake command, then apply
+    log.write("\nRunning cmake command:")
+    log.write(" ".join(shlex.quote(a) for a in mystr)+'\n')
+
+    returncode = 0
+    if not args.dry_run:
+        build_dir = os.getcwd()
+        fp = fingerprint(mystr,args.source[0])
+        if not args.force and is_configured(build_dir,fp):
+            log.write("Configuration unchanged since the last run, skipping cmake and the source cleanup (use --force to rerun).")
+        else:
+            record_fingerprint(build_dir,None)
+            returncode = run_cmake(mystr,log)
+            returncode = clean_sources(args.source[0],build_dir,log) or returncode
+            if returncode == 0:
+                record_fingerprint(build_dir,fp)
+    log.close()
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main())
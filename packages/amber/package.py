@@ -3,13 +3,555 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+import contextlib
+import errno
+import glob
+import hashlib
+import importlib.util
+import json
 import os
+import platform
+import re
+import resource as rusage  # the name resource is taken by the Spack directive
+import shlex
 import shutil
+import signal
+import subprocess
+import threading
+import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
+import llnl.util.tty as tty
+
+import spack.caches
+import spack.relocate
+import spack.util.web
+from spack.fetch_strategy import ChecksumError, FetchError
 from spack.package import *
 from spack.util.environment import EnvironmentModifications
 
 
+# Upstream location of the Amber bugfix patches
+_patch_url_base = "https://ambermd.org/bugfixes"
+
+# Optional local patch bundle (a directory or file:// URL) created with
+# Amber.create_patch_bundle. When set, patches are fetched from the bundle
+# by checksum instead of from ambermd.org. The checksums are unchanged, so
+# are the concretized specs.
+_patch_bundle = os.environ.get("AMBER_PATCH_BUNDLE")
+
+
+def _bundle_path(bundle, checksum):
+    """Path of the patch with ``checksum`` inside a patch bundle."""
+    return os.path.join(bundle, checksum[:2], checksum)
+
+
+def _patch_url(version, number, checksum):
+    if _patch_bundle:
+        bundle = _patch_bundle
+        if not bundle.startswith("file://"):
+            bundle = "file://" + os.path.abspath(bundle)
+        return _bundle_path(bundle, checksum)
+    return "{0}/{1}.0/update.{2}".format(_patch_url_base, version, number)
+
+
+def _merge_tree(src, dest):
+    """Move the contents of ``src`` into ``dest``, replacing existing files.
+
+    Entries missing from ``dest`` are renamed into place, so whole
+    subdirectories move in constant time. Directories present on both sides
+    are merged recursively. Renames that cross a filesystem boundary fall
+    back to a copy.
+
+    Returns a ``(moved, copied)`` tuple with the number of entries that were
+    renamed and the number of bytes that had to be written.
+    """
+    moved, copied = 0, 0
+    for name in os.listdir(src):
+        src_path = os.path.join(src, name)
+        dest_path = os.path.join(dest, name)
+        if os.path.isdir(dest_path) and not os.path.islink(dest_path):
+            if os.path.isdir(src_path) and not os.path.islink(src_path):
+                sub_moved, sub_copied = _merge_tree(src_path, dest_path)
+                moved += sub_moved
+                copied += sub_copied
+                continue
+            shutil.rmtree(dest_path)
+        elif os.path.isdir(src_path) and os.path.lexists(dest_path):
+            os.remove(dest_path)
+        try:
+            os.replace(src_path, dest_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            if os.path.lexists(dest_path):
+                os.remove(dest_path)
+            shutil.move(src_path, dest_path)
+            copied += _tree_size(dest_path)
+        moved += 1
+    return moved, copied
+
+
+def _tree_size(path):
+    """Return the apparent size in bytes of a file or directory tree."""
+    if not os.path.isdir(path) or os.path.islink(path):
+        return os.lstat(path).st_size
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for name in dirs + files:
+            total += os.lstat(os.path.join(root, name)).st_size
+    return total
+
+
+def _human_size(size):
+    """Format a byte count for the install log."""
+    units = ("B", "KB", "MB", "GB", "TB")
+    for unit in units:
+        if abs(size) < 1024.0 or unit == units[-1]:
+            break
+        size /= 1024.0
+    return "{0:.1f} {1}".format(size, unit) if unit != "B" else "{0} B".format(size)
+
+
+def _install_file(src, dest, link=False):
+    """Install a single file or symlink, hardlinking it when ``link`` is set.
+
+    Returns the number of bytes written, which is zero for links.
+    """
+    if os.path.lexists(dest):
+        os.remove(dest)
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dest)
+        return 0
+    if link:
+        try:
+            os.link(src, dest)
+            return 0
+        except OSError:
+            pass
+    shutil.copy2(src, dest)
+    return os.path.getsize(dest)
+
+
+def _install_manifest(src, dest, manifest, link=False):
+    """Install the entries of ``manifest`` found below ``src`` into ``dest``.
+
+    Manifest entries are paths relative to ``src`` and may contain
+    wildcards. Directories are installed recursively. Returns a
+    ``(files, written)`` tuple with the number of files installed and the
+    bytes written for them.
+    """
+    files, written = 0, 0
+    for pattern in manifest:
+        for path in sorted(glob.glob(os.path.join(src, pattern))):
+            if not os.path.isdir(path) or os.path.islink(path):
+                target = os.path.join(dest, os.path.relpath(path, src))
+                mkdirp(os.path.dirname(target))
+                written += _install_file(path, target, link)
+                files += 1
+                continue
+            for root, dirs, names in os.walk(path):
+                target_root = os.path.join(dest, os.path.relpath(root, src))
+                mkdirp(target_root)
+                # os.walk does not descend into symlinked directories, so
+                # those are recreated as links like regular files
+                names += [d for d in dirs if os.path.islink(os.path.join(root, d))]
+                for name in names:
+                    written += _install_file(
+                        os.path.join(root, name), os.path.join(target_root, name), link
+                    )
+                    files += 1
+    return files, written
+
+
+# EnvironmentModifications entries that can be stored in the cached run
+# environment, mapped to the method that recreates them
+_env_actions = {
+    "SetEnv": "set",
+    "UnsetEnv": "unset",
+    "SetPath": "set_path",
+    "AppendPath": "append_path",
+    "PrependPath": "prepend_path",
+    "RemovePath": "remove_path",
+}
+
+
+def _file_sha256(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+# Stands for the install prefix in the cached run environment, so that the
+# cache stays valid when a binary cache installs Amber to another prefix
+_prefix_placeholder = "@AMBER_PREFIX@"
+
+
+def _replace_prefix(value, old, new):
+    """Replace ``old`` in a modification value, element-wise for path lists."""
+    if isinstance(value, (list, tuple)):
+        return [str(v).replace(old, new) for v in value]
+    return str(value).replace(old, new)
+
+
+def _script_sha256(filename, prefix):
+    """Hash ``filename`` with the occurrences of ``prefix`` normalized."""
+    with open(filename, "rb") as f:
+        data = f.read()
+    data = data.replace(prefix.encode(), _prefix_placeholder.encode())
+    return hashlib.sha256(data).hexdigest()
+
+
+def _dump_env_modifications(modifications, source, cache_file, prefix):
+    """Store ``modifications`` obtained by sourcing ``source`` as JSON.
+
+    Occurrences of ``prefix`` are stored as a placeholder. Returns False if
+    a modification cannot be represented, in which case nothing is written.
+    """
+    entries = []
+    for item in modifications:
+        action = _env_actions.get(type(item).__name__)
+        if action is None:
+            return False
+        entry = {"action": action, "name": item.name}
+        if action != "unset":
+            entry["value"] = _replace_prefix(item.value, prefix, _prefix_placeholder)
+        if action.endswith("_path"):
+            entry["separator"] = item.separator
+        entries.append(entry)
+    data = {
+        "source": os.path.basename(source),
+        "mtime": os.stat(source).st_mtime,
+        "sha256": _script_sha256(source, prefix),
+        "modifications": entries,
+    }
+    mkdirp(os.path.dirname(cache_file))
+    with open(cache_file, "w") as f:
+        json.dump(data, f, indent=2)
+    return True
+
+
+def _load_env_modifications(source, cache_file, prefix):
+    """Return the cached modifications for ``source`` or None if stale.
+
+    The cache is valid if ``source`` has the recorded mtime or, failing
+    that, the recorded content hash, ignoring the install prefix.
+    """
+    try:
+        with open(cache_file) as f:
+            data = json.load(f)
+        if (
+            os.stat(source).st_mtime != data["mtime"]
+            and _script_sha256(source, prefix) != data["sha256"]
+        ):
+            return None
+        modifications = EnvironmentModifications()
+        for entry in data["modifications"]:
+            if entry["action"] not in _env_actions.values():
+                return None
+            args = [entry["name"]]
+            if "value" in entry:
+                args.append(_replace_prefix(entry["value"], _prefix_placeholder, prefix))
+            kwargs = {"separator": entry["separator"]} if "separator" in entry else {}
+            getattr(modifications, entry["action"])(*args, **kwargs)
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        # missing or malformed cache
+        return None
+    return modifications
+
+
+# Headers replacing the AMBERHOME assignment of amber.sh and amber.csh, so
+# that AMBERHOME follows the script when the installation is relocated
+_relocatable_sh = """\
+# Set AMBERHOME from the location of this script, so that the installation
+# keeps working when it is relocated. Falls back to the install prefix for
+# shells that cannot tell which file is being sourced.
+amber_sh_dir=""
+if [ -n "${{BASH_SOURCE:-}}" ]; then
+    amber_sh_dir="$(cd "$(dirname "${{BASH_SOURCE}}")" && pwd)"
+elif [ -n "${{ZSH_VERSION:-}}" ]; then
+    eval 'amber_sh_dir="$(cd "$(dirname "${{(%):-%x}}")" && pwd)"'
+fi
+export AMBERHOME="${{amber_sh_dir:-{0}}}"
+unset amber_sh_dir
+"""
+
+_relocatable_csh = """\
+# Set AMBERHOME from the location of this script, so that the installation
+# keeps working when it is relocated. tcsh reports the sourced file in $_,
+# other shells fall back to the install prefix.
+set amber_csh_dir = ""
+if ( $?_ ) then
+    set amber_csh_cmd = ( $_ )
+    if ( $#amber_csh_cmd >= 2 ) then
+        if ( "$amber_csh_cmd[2]:t" == "amber.csh" ) set amber_csh_dir = "$amber_csh_cmd[2]:h"
+    endif
+    unset amber_csh_cmd
+endif
+if ( "$amber_csh_dir" != "" ) then
+    setenv AMBERHOME `cd "$amber_csh_dir" && pwd`
+else
+    setenv AMBERHOME "{0}"
+endif
+unset amber_csh_dir
+"""
+
+_relocatable_scripts = {
+    "amber.sh": (r"^[ \t]*(export[ \t]+)?AMBERHOME=.*$\n?", _relocatable_sh),
+    "amber.csh": (r"^[ \t]*setenv[ \t]+AMBERHOME[ \t].*$\n?", _relocatable_csh),
+}
+
+
+def _make_relocatable(script, prefix):
+    """Rewrite amber.sh or amber.csh to derive AMBERHOME from its location.
+
+    Returns False if the script does not set AMBERHOME as expected.
+    """
+    pattern, header = _relocatable_scripts[os.path.basename(script)]
+    with open(script) as f:
+        text = f.read()
+    match = re.search(pattern, text, re.MULTILINE)
+    if match is None:
+        return False
+    body = text[match.end() :].replace(prefix, "${AMBERHOME}")
+    with open(script, "w") as f:
+        f.write(text[: match.start()] + header.format(prefix) + body)
+    return True
+
+
+def _find_regression_tests(roots):
+    """Map each test directory under ``roots`` to its ``Run.*`` scripts."""
+    tests = {}
+    for root in roots:
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            scripts = [
+                os.path.join(dirpath, name)
+                for name in sorted(filenames)
+                if name.startswith("Run.")
+                and not name.endswith((".save", ".dif", ".diff"))
+                and os.access(os.path.join(dirpath, name), os.X_OK)
+            ]
+            if scripts:
+                tests[dirpath] = scripts
+    return tests
+
+
+def _run_regression_test(script, env, timeout):
+    """Run one ``Run.*`` script and classify its outcome.
+
+    Amber's dacdif prints PASSED or "possible FAILURE" for each comparison
+    against the saved output; a script that exits cleanly without either
+    is treated as skipped (missing optional program, unsupported build).
+    """
+    start = time.time()
+    process = subprocess.Popen(
+        ["./" + os.path.basename(script)],
+        cwd=os.path.dirname(script),
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+        start_new_session=True,
+    )
+    try:
+        output, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # the group exited between the timeout and the kill
+            pass
+        output, _ = process.communicate()
+        status = "timeout"
+    else:
+        if "possible FAILURE" in output:
+            status = "diff"
+        elif process.returncode != 0:
+            status = "fail"
+        elif "PASSED" in output:
+            status = "pass"
+        else:
+            status = "skipped"
+    return {
+        "test": script,
+        "status": status,
+        "returncode": process.returncode,
+        "seconds": round(time.time() - start, 1),
+        "output": output[-4000:],
+    }
+
+
+def _shadow_tree(src, dest, copied):
+    """Mirror ``src`` in ``dest`` with symlinks, copying the ``copied`` paths.
+
+    ``copied`` holds paths relative to ``src``; their parents are recreated
+    as directories so that only those paths are writable copies.
+    """
+    parents = set()
+    for path in copied:
+        parent = os.path.dirname(path)
+        while parent:
+            parents.add(parent)
+            parent = os.path.dirname(parent)
+
+    def mirror(relative):
+        mkdirp(os.path.join(dest, relative))
+        for name in os.listdir(os.path.join(src, relative)):
+            path = os.path.join(relative, name)
+            if path in copied:
+                shutil.copytree(os.path.join(src, path), os.path.join(dest, path), symlinks=True)
+            elif path in parents and os.path.isdir(os.path.join(src, path)):
+                mirror(path)
+            else:
+                os.symlink(os.path.join(src, path), os.path.join(dest, path))
+
+    mirror("")
+
+
+def _junit_report(results, filename):
+    """Write the regression results as a JUnit XML file."""
+    suite = ElementTree.Element(
+        "testsuite",
+        name="amber",
+        tests=str(len(results)),
+        failures=str(sum(r["status"] == "diff" for r in results)),
+        errors=str(sum(r["status"] in ("fail", "timeout") for r in results)),
+        skipped=str(sum(r["status"] == "skipped" for r in results)),
+    )
+    for result in results:
+        directory, name = os.path.split(result["test"])
+        case = ElementTree.SubElement(
+            suite, "testcase", classname=directory, name=name, time=str(result["seconds"])
+        )
+        if result["status"] == "diff":
+            element = ElementTree.SubElement(case, "failure", message="possible FAILURE")
+            element.text = result["output"]
+        elif result["status"] in ("fail", "timeout"):
+            element = ElementTree.SubElement(case, "error", message=result["status"])
+            element.text = result["output"]
+        elif result["status"] == "skipped":
+            ElementTree.SubElement(case, "skipped")
+    ElementTree.ElementTree(suite).write(filename, encoding="utf-8", xml_declaration=True)
+
+
+def _expand_tarball(archive, stage, tar, decompressor):
+    """Expand ``archive`` into ``stage.source_path`` like Spack would.
+
+    A single top-level directory becomes the source path, otherwise the
+    entries are moved into it. Returns False if the extraction failed.
+    """
+    tmpdir = os.path.join(stage.path, "spack-expanded-archive")
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    mkdirp(tmpdir)
+    returncode = subprocess.call(
+        [tar, "--use-compress-program=" + decompressor, "-xf", archive, "-C", tmpdir]
+    )
+    if returncode != 0:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        return False
+    entries = os.listdir(tmpdir)
+    if len(entries) == 1 and os.path.isdir(os.path.join(tmpdir, entries[0])):
+        os.rename(os.path.join(tmpdir, entries[0]), stage.source_path)
+        os.rmdir(tmpdir)
+    else:
+        os.rename(tmpdir, stage.source_path)
+    return True
+
+
+def _run_logged(args, cwd, log_path, env=None, record=None):
+    """Run ``args`` inside ``cwd``, appending stdout and stderr to ``log_path``.
+
+    Unlike an ``Executable`` this does not change the working directory of
+    the calling process, so it is safe to use from several threads. Without
+    ``log_path`` the output goes to the build log like that of an
+    ``Executable``. The CPU time and peak memory of the command are added
+    to ``record``, a telemetry record from ``Amber._phase``, if given.
+    """
+    tty.debug("[{0}] {1}".format(cwd, " ".join(args)))
+    log = open(log_path, "ab") if log_path else None
+    try:
+        if log:
+            log.write("==> [{0}] {1}\n".format(cwd, " ".join(args)).encode())
+            log.flush()
+        proc = subprocess.Popen(
+            args, cwd=cwd, env=env, stdout=log, stderr=subprocess.STDOUT if log else None
+        )
+        _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+        if log:
+            log.close()
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+    if record is not None:
+        record["command_cpu_seconds"] = (
+            record.get("command_cpu_seconds", 0.0) + usage.ru_utime + usage.ru_stime
+        )
+        record["command_max_rss_kb"] = max(record.get("command_max_rss_kb", 0), usage.ru_maxrss)
+    if proc.returncode != 0:
+        raise InstallError(
+            "Command exited with status {0}: '{1}'".format(proc.returncode, " ".join(args)),
+            "See {0} for the complete output".format(log_path or "the build log"),
+        )
+
+
+def _ccache_stats(ccache):
+    """Return the counters of ``ccache --print-stats`` as a dict of ints."""
+    stats = {}
+    for line in ccache("--print-stats", output=str).splitlines():
+        key, _, value = line.partition("\t")
+        if value.strip().isdigit():
+            stats[key.strip()] = int(value)
+    return stats
+
+
+def _bytes_written():
+    """Bytes this process and its reaped children wrote to storage, if known."""
+    try:
+        with open("/proc/self/io") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except (IOError, OSError):
+        pass
+    return None
+
+
+def _disk_usage(paths):
+    """Space allocated to the trees below ``paths``, counting each inode once.
+
+    Missing paths count as empty, so a tree created during a step is
+    measured in full. Entries removed while walking are skipped.
+    """
+    seen, total = set(), 0
+    for path in paths:
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                try:
+                    st = os.lstat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                if (st.st_dev, st.st_ino) not in seen:
+                    seen.add((st.st_dev, st.st_ino))
+                    total += st.st_blocks * 512
+    return total
+
+
+def _replace_in_scripts(path, old, new):
+    """Replace ``old`` with ``new`` in the text files below ``path``."""
+    old, new = old.encode(), new.encode()
+    for root, _, files in os.walk(path):
+        for name in files:
+            filename = os.path.join(root, name)
+            if os.path.islink(filename) or os.path.getsize(filename) > 1 << 20:
+                continue
+            with open(filename, "rb") as f:
+                data = f.read()
+            if old in data and b"\0" not in data:
+                with open(filename, "wb") as f:
+                    f.write(data.replace(old, new))
+
+
 class Amber(Package, CudaPackage):
     """Amber is a suite of biomolecular simulation programs together
     with Amber tools.
@@ -104,8 +646,7 @@ class Amber(Package, CudaPackage):
         ("16", "15", "a156ec246cd06688043cefde24de0d715fd46b08f5c0235015c2c5c3c6e37488"),
     ]
     for ver, num, checksum in patches:
-        patch_url_str = "https://ambermd.org/bugfixes/{0}.0/update.{1}"
-        patch(patch_url_str.format(ver, num), sha256=checksum, level=0, when="@{0}".format(ver))
+        patch(_patch_url(ver, num, checksum), sha256=checksum, level=0, when="@{0}".format(ver))
 
     # Patch to move the namelist sebomd after the variable declarations
     # Taken from http://archive.ambermd.org/202105/0098.html
@@ -128,15 +669,83 @@ class Amber(Package, CudaPackage):
     variant("openmp", description="Use OpenMP pragmas to parallelize", default=False)
     variant("x11", description="Build programs that require X11", default=False)
     variant("update", description="Update the sources prior compilation", default=False)
+    variant("ninja", description="Generate Ninja build files", default=False, when="@22:")
+    variant("ccache", description="Compile through a shared ccache", default=False)
+    variant(
+        "unity_build",
+        description="Combine C/C++ sources into unity translation units",
+        default=False,
+        when="@22:",
+    )
+    variant(
+        "profile",
+        description="What to install besides the runtime: "
+        "runtime only, with the regression tests, or with tests, examples and benchmarks",
+        default="full",
+        values=("runtime", "tests", "full"),
+        multi=False,
+    )
+    variant(
+        "disable_tools",
+        description="AmberTools programs not to build",
+        values=any_combination_of(
+            "mdgx",
+            "mm_pbsa",
+            "mmpbsa_py",
+            "nmode",
+            "packmol_memgen",
+            "paramfit",
+            "pymsmt",
+            "pytraj",
+            "quick",
+            "reduce",
+            "saxs",
+            "sebomd",
+            "xtalutil",
+        ),
+        when="@22:",
+    )
+    variant(
+        "link_install",
+        description="Hardlink runtime files from the build tree into the prefix",
+        default=False,
+    )
+    variant(
+        "parallel_variants",
+        description="Build the MPI/CUDA/OpenMP flavors concurrently in separate trees",
+        default=False,
+    )
 
     depends_on("zlib")
     depends_on("bzip2")
+    depends_on("cmake@3.8.1:", type="build", when="@22:")
+    depends_on("ninja", type="build", when="+ninja")
+    # --print-stats
+    depends_on("ccache@4.4:", type="build", when="+ccache")
     depends_on("flex", type="build")
     depends_on("bison", type="build")
+    depends_on("netcdf-c")
     depends_on("netcdf-fortran")
     depends_on("parallel-netcdf", when="@22:")  # when='AmberTools@22:'
     depends_on("parallel-netcdf", when="@20:")  # when='AmberTools@21:'
     depends_on("tcsh", type=("build"), when="@20")  # when='AmberTools@21:'
+
+    # Amber 22 builds its python programs against the Spack python and
+    # uses Spack libraries in place of the bundled ones
+    with when("@22:"):
+        depends_on("python@3.6:", type=("build", "run"))
+        depends_on("py-setuptools", type="build")
+        depends_on("py-cython", type="build")
+        depends_on("py-numpy", type=("build", "run"))
+        depends_on("py-scipy", type=("build", "run"))
+        depends_on("py-matplotlib", type=("build", "run"))
+        depends_on(
+            "boost+chrono+filesystem+iostreams+program_options+regex+system+thread+timer"
+        )
+        depends_on("fftw")
+        depends_on("fftw+mpi", when="+mpi")
+        depends_on("blas")
+        depends_on("lapack")
     # Potential issues with openmpi 4
     # (http://archive.ambermd.org/201908/0105.html)
     depends_on("mpi", when="+mpi")
@@ -156,10 +765,108 @@ class Amber(Package, CudaPackage):
     )
     conflicts("+openmp", when="%pgi", msg="OpenMP not available for the pgi compiler")
 
+    # Runtime artifacts installed from AMBERHOME by the legacy build. The
+    # Amber 22 CMake build installs its own files into the prefix.
+    install_manifest = [
+        "amber.sh",
+        "amber.csh",
+        "bin",
+        "dat",
+        "include",
+        "lib",
+        "lib64",
+        "share",
+    ]
+    # Added to the runtime by the "tests" and "full" install profiles
+    test_manifest = ["test", "AmberTools/test"]
+    example_manifest = ["examples", "AmberTools/examples", "benchmarks", "AmberTools/benchmarks"]
+    # what the relocation test copies out of the prefix
+    relocation_manifest = ["amber.sh", "amber.csh", "bin", "lib*", "dat", ".spack"]
+
+    # Spack packages used in place of the libraries bundled with Amber 22,
+    # mapped to their names in the Amber build system
+    external_libs = {
+        "zlib": "zlib",
+        "bzip2": "libbz2",
+        "netcdf-c": "netcdf",
+        "netcdf-fortran": "netcdf-fortran",
+        "parallel-netcdf": "pnetcdf",
+        "boost": "boost",
+        "fftw": "fftw",
+        "blas": "blas",
+        "lapack": "lapack",
+    }
+
+    # Environment modifications of amber.sh, cached at install time
+    env_cache = join_path(".spack", "amber_env.json")
+
+    @classmethod
+    def create_patch_bundle(cls, bundle, mirror=_patch_url_base, jobs=8):
+        """Create or refresh a local bundle holding every patch in ``patches``.
+
+        Patches are stored as ``<bundle>/<sha256[:2]>/<sha256>`` next to an
+        ``index.json`` that maps ``<version>/update.<n>`` to its checksum.
+        They are downloaded from ``mirror``, which follows the layout of
+        ambermd.org/bugfixes and may be a file:// URL. Downloads and
+        checksum verification run in ``jobs`` threads. Patches already in
+        the bundle are verified but not downloaded again.
+
+        Run it with ``spack python``, then point AMBER_PATCH_BUNDLE at the
+        bundle to install from it::
+
+            import spack.repo
+            spack.repo.path.get_pkg_class("amber").create_patch_bundle("/srv/amber")
+        """
+        bundle = os.path.abspath(bundle)
+
+        def fetch(entry):
+            ver, num, checksum = entry
+            path = _bundle_path(bundle, checksum)
+            if os.path.exists(path) and _file_sha256(path) == checksum:
+                return None
+            url = "{0}/{1}.0/update.{2}".format(mirror.rstrip("/"), ver, num)
+            _, _, response = spack.util.web.read_from_url(url)
+            data = response.read()
+            if hashlib.sha256(data).hexdigest() != checksum:
+                return url
+            mkdirp(os.path.dirname(path))
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path)
+            return None
+
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            failed = [url for url in executor.map(fetch, cls.patches) if url]
+        if failed:
+            raise ChecksumError("Checksum mismatch for patches", "\n".join(failed))
+
+        index = dict(
+            ("{0}/update.{1}".format(ver, num), checksum) for ver, num, checksum in cls.patches
+        )
+        with open(os.path.join(bundle, "index.json"), "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        tty.msg("Amber patch bundle with {0} patches in {1}".format(len(index), bundle))
+
+    # CPU benchmarks shipped with Amber that are run by ``spack test``,
+    # shortened to ``benchmark_steps`` MD steps
+    benchmark_systems = ["jac", "dhfr"]
+    benchmark_steps = 1000
+    benchmark_ranks = 4
+
+    # per-test timeout of the regression runner in seconds, overridable
+    # with AMBER_TEST_TIMEOUT
+    regression_timeout = 1800
+
     def url_for_version(self, version):
         url = "file://{0}/Amber{1}.tar.bz2".format(os.getcwd(), version)
         return url
 
+    @property
+    def ccache_dir(self):
+        """Compiler cache shared by all flavors and all Amber installs."""
+        default = join_path(spack.caches.misc_cache.root, "amber-ccache")
+        return os.environ.get("AMBER_CCACHE_DIR", default)
+
     def setup_build_environment(self, env):
         amber_src = self.stage.source_path
         env.set("AMBERHOME", amber_src)
@@ -174,13 +881,80 @@ class Amber(Package, CudaPackage):
         if self.spec.satisfies("+cuda"):
             env.set("CUDA_HOME", self.spec["cuda"].prefix)
 
+        # Spack disables ccache unless it is enabled globally
+        if self.spec.satisfies("+ccache"):
+            env.unset("CCACHE_DISABLE")
+            env.set("CCACHE_DIR", self.ccache_dir)
+            # ccache evicts the least recently used entries beyond this size
+            env.set("CCACHE_MAXSIZE", os.environ.get("AMBER_CCACHE_MAXSIZE", "20G"))
+            # Hash paths relative to the stage, so that the separate trees of
+            # the flavors share entries
+            env.set("CCACHE_BASEDIR", self.stage.path)
+            if self.spec.satisfies("@:21"):
+                # The legacy configure has no launcher setting; let the Spack
+                # compiler wrappers call ccache for C and C++ instead
+                env.set("SPACK_CCACHE_BINARY", self.spec["ccache"].prefix.bin.ccache)
+
+    def do_stage(self, mirror_only=False):
+        """Stage the sources, expanding the tarballs with parallel bzip2.
+
+        The Amber and AmberTools tarballs are expanded concurrently with
+        lbzip2 or pbzip2 when one is found in PATH; Spack's own expansion
+        then finds them in place and only moves the resources. Without a
+        parallel bzip2, or if it fails, Spack expands them as usual.
+        """
+        self._telemetry = []
+        self.stage.create()
+        self.do_fetch(mirror_only)
+        tar = which("tar")
+        decompressor = which("lbzip2") or which("pbzip2")
+        with self._phase("expand sources") as record:
+            pending = [
+                stage
+                for stage in self.stage
+                if not stage.expanded
+                and stage.archive_file
+                and stage.archive_file.endswith((".tar.bz2", ".tbz2"))
+            ]
+            if tar and decompressor and pending:
+                record["decompressor"] = os.path.basename(decompressor.path)
+
+                def expand(stage):
+                    if not _expand_tarball(stage.archive_file, stage, tar.path, decompressor.path):
+                        tty.warn("Parallel expansion of {0} failed".format(stage.archive_file))
+
+                with ThreadPoolExecutor(max_workers=len(pending)) as executor:
+                    list(executor.map(expand, pending))
+            self.stage.expand_archive()
+        tty.msg(
+            "Expanded the sources in {0:.1f}s with {1}".format(
+                record["wall_seconds"], record.get("decompressor", "the default tools")
+            )
+        )
+        if not os.listdir(self.stage.path):
+            raise FetchError("Archive was empty for {0}".format(self.name))
+
     def install(self, spec, prefix):
+        if self.spec.satisfies("+ccache"):
+            # Snapshot the counters instead of zeroing them, the cache is shared
+            # with other builds
+            self._ccache_stats = _ccache_stats(Executable(self.spec["ccache"].prefix.bin.ccache))
+
         # The resource command does not allow us to expand the package in the
         # root stage folder as required, as it already contains files. Here we
-        # install AmberTools where it should be, which results in 3 copies of
-        # the  ambertools (~9 GB). This has to be improved in the future.
-        install_tree("ambertools_tmpdir", ".")
-        shutil.rmtree(join_path(self.stage.source_path, "ambertools_tmpdir"))
+        # move AmberTools where it should be: entries are renamed into place,
+        # so no data is copied unless the trees live on different filesystems.
+        if not hasattr(self, "_telemetry"):
+            self._telemetry = []
+        ambertools_tmpdir = join_path(self.stage.source_path, "ambertools_tmpdir")
+        with self._phase("stage AmberTools") as record:
+            moved, copied = _merge_tree(ambertools_tmpdir, self.stage.source_path)
+            shutil.rmtree(ambertools_tmpdir)
+        tty.msg(
+            "Staged AmberTools: {0} entries moved, {1} bytes written in {2:.2f}s".format(
+                moved, copied, record["wall_seconds"]
+            )
+        )
 
         # Select compiler style
         if self.spec.satisfies("%cce"):
@@ -209,40 +983,52 @@ class Amber(Package, CudaPackage):
         # Amber 22 introduced a new configure_cmake script
         # Base configuration
         if str(self.version) == "22":
-            os.chdir('build')
-            conf = Executable("./configure_cmake.py")
+            external_libs = [
+                name for dep, name in self.external_libs.items() if spec.satisfies("^" + dep)
+            ]
             base_args = [
                 "--prefix", prefix,
+                "--compiler", compiler,
+                "--with-python", spec["python"].command.path,
+                "--no-check-updates",
+                "--force-external-libs", ",".join(external_libs),
             ]
 
             if self.spec.satisfies("~x11"):
                 base_args += ["--noX11"]
 
-            # Single core
-            # conf(*(base_args + [compiler]))
-            conf(*(base_args))
-
-            # CUDA
-            if self.spec.satisfies("+cuda"):
-                conf(*(base_args + ["--cuda", "--compiler", compiler]))
-
-            ## MPI
-            if self.spec.satisfies("+mpi"):
-                conf(*(base_args + ["--mpi", "--compiler", compiler]))
+            if self.spec.satisfies("+ninja"):
+                base_args += ["--generator", "Ninja"]
+            if self.spec.satisfies("+ccache"):
+                base_args += ["--compiler-launcher", self.spec["ccache"].prefix.bin.ccache]
+            if self.spec.satisfies("+unity_build"):
+                base_args += ["--unity-build"]
+            if self.spec.satisfies("profile=runtime"):
+                base_args += ["--no-install-tests"]
+            else:
+                base_args += ["--install-tests"]
+            disabled = [t for t in self.spec.variants["disable_tools"].value if t != "none"]
+            if disabled:
+                base_args += ["--disable-tools", ",".join(disabled)]
 
-            ## Openmp
-            if self.spec.satisfies("+openmp"):
-                conf(*(base_args + ["--openmp", "--compiler", compiler]))
+            self._build_cmake_flavors(base_args)
 
-            ## CUDA + MPI
-            if self.spec.satisfies("+cuda") and self.spec.satisfies("+mpi"):
-                conf(*(base_args + ["--cuda", "--mpi", "--compiler", compiler]))
+            # INSTALL_TESTS also covers the examples and benchmarks, which
+            # the "tests" profile leaves out
+            if self.spec.satisfies("profile=tests"):
+                for entry in self.example_manifest:
+                    for path in glob.glob(join_path(prefix, entry)):
+                        shutil.rmtree(path)
 
-            make("install")
-            ## just install everything that was built
-            install_tree(".", prefix)
+            # cmake already installed into the prefix; the build trees
+            # only hold objects and are left behind in the stage
+            build_trees = glob.glob(join_path(self.stage.source_path, "build-*"))
+            tty.msg(
+                "Installed with CMake, skipped {0} of build trees".format(
+                    _human_size(sum(_tree_size(d) for d in build_trees))
+                )
+            )
         else:
-            conf = Executable("./configure")
             base_args = [
                 "--skip-python",
                 "--with-netcdf",
@@ -262,34 +1048,564 @@ class Amber(Package, CudaPackage):
             if self.spec.target.family != "x86_64":
                 base_args += ["-nosse"]
 
-            # Single core
-            conf(*(base_args + [compiler]))
-            make("install")
+            # Run like the parallel flavors, so that telemetry gets the peak RSS
+            source_path = self.stage.source_path
+            configure = ["./configure"] + base_args
+            make_target = ["make", "-j{0}".format(make_jobs)]
+            flavors = self._legacy_flavors()
+            if self.spec.satisfies("+parallel_variants") and len(flavors) > 2:
+                # The serial build goes first with the full job budget, as the
+                # parallel flavors reuse the libraries it installs.
+                name, flags, target, clean = flavors[0]
+                with self._phase("configure serial") as record:
+                    _run_logged(configure + flags + [compiler], source_path, None, record=record)
+                with self._phase("build serial") as record:
+                    _run_logged(make_target + [target], source_path, None, record=record)
+                self._build_legacy_flavors(flavors[1:], base_args, compiler)
+            else:
+                for name, flags, target, clean in flavors:
+                    with self._phase("configure {0}".format(name)) as record:
+                        if clean:
+                            _run_logged(["make", "clean"], source_path, None, record=record)
+                        _run_logged(
+                            configure + flags + [compiler], source_path, None, record=record
+                        )
+                    with self._phase("build {0}".format(name)) as record:
+                        _run_logged(make_target + [target], source_path, None, record=record)
+
+            with self._phase("install"):
+                self._install_runtime(prefix)
 
-            # CUDA
-            if self.spec.satisfies("+cuda"):
-                conf(*(base_args + ["-cuda", compiler]))
-                make("install")
+    @contextlib.contextmanager
+    def _phase(self, name, paths=None):
+        """Record wall time, CPU time, disk writes and growth of a step.
 
-            # MPI
-            if self.spec.satisfies("+mpi"):
-                conf(*(base_args + ["-mpi", compiler]))
-                make("install")
+        Yields the telemetry record, which can be passed to ``_run_logged``
+        so that CPU time and peak RSS come from the commands of the step
+        alone. Otherwise CPU time is measured for the whole process and the
+        peak RSS, which the process only reports over its lifetime, is left
+        out. The I/O counters are always those of the whole process, which
+        means that they include any step running concurrently. The disk
+        growth is that of ``paths``, the trees the step writes to, by default
+        the stage and the prefix; steps running concurrently pass their own.
+        The trees are walked outside of the timed interval.
+        """
+        paths = paths or [self.stage.path, self.prefix]
+        who = (rusage.RUSAGE_SELF, rusage.RUSAGE_CHILDREN)
+        record = {"phase": name}
+        disk = _disk_usage(paths)
+        wall = time.time()
+        usage = [rusage.getrusage(w) for w in who]
+        written = _bytes_written()
+        try:
+            yield record
+        finally:
+            end = [rusage.getrusage(w) for w in who]
+            cpu = sum(
+                e.ru_utime + e.ru_stime - u.ru_utime - u.ru_stime for u, e in zip(usage, end)
+            )
+            record["wall_seconds"] = round(time.time() - wall, 3)
+            record["cpu_seconds"] = round(record.pop("command_cpu_seconds", cpu), 3)
+            if "command_max_rss_kb" in record:
+                record["max_rss_kb"] = record.pop("command_max_rss_kb")
+            if written is not None:
+                record["bytes_written"] = _bytes_written() - written
+            record["disk_growth"] = _disk_usage(paths) - disk
+            self._telemetry.append(record)
+
+    @run_after("install")
+    def write_telemetry(self):
+        """Save the per-phase build telemetry and summarize it in the log."""
+        telemetry = getattr(self, "_telemetry", [])
+        if not telemetry:
+            return
+        filename = join_path(self.prefix, ".spack", "amber-build-telemetry.json")
+        with open(filename, "w") as f:
+            json.dump(
+                {
+                    "spec": self.spec.format("{name}{@version}{%compiler}{variants}"),
+                    "make_jobs": make_jobs,
+                    "phases": telemetry,
+                },
+                f,
+                indent=2,
+            )
+        row = "{0:<24} {1:>10} {2:>10} {3:>10} {4:>10}"
+        lines = [row.format("phase", "wall [s]", "cpu [s]", "written", "disk")]
+        for record in telemetry:
+            lines.append(
+                row.format(
+                    record["phase"],
+                    "{0:.1f}".format(record["wall_seconds"]),
+                    "{0:.1f}".format(record["cpu_seconds"]),
+                    _human_size(record.get("bytes_written", 0)),
+                    _human_size(record["disk_growth"]),
+                )
+            )
+        tty.msg("Build telemetry saved to {0}".format(filename), *lines)
+
+    @run_after("install")
+    def report_prefix_size(self):
+        """Report the size of the prefix, which grows with the install profile."""
+        tty.msg(
+            "Installed prefix ({0} profile): {1}".format(
+                self.spec.variants["profile"].value, _human_size(_tree_size(self.prefix))
+            )
+        )
+
+    @run_after("install")
+    def report_ccache(self):
+        """Report the ccache counters that changed during this install.
+
+        Builds running concurrently against the same cache are counted too.
+        """
+        if not self.spec.satisfies("+ccache") or not hasattr(self, "_ccache_stats"):
+            return
+        after = _ccache_stats(Executable(self.spec["ccache"].prefix.bin.ccache))
+        delta = {
+            key: value - self._ccache_stats.get(key, 0)
+            for key, value in after.items()
+            if not key.endswith("_timestamp") and value != self._ccache_stats.get(key, 0)
+        }
+        hits = delta.get("direct_cache_hit", 0) + delta.get("preprocessed_cache_hit", 0)
+        lookups = hits + delta.get("cache_miss", 0)
+        tty.msg(
+            "ccache statistics for {0}: {1} hits, {2} misses{3}".format(
+                self.ccache_dir,
+                hits,
+                delta.get("cache_miss", 0),
+                " ({0:.0%} hit rate)".format(hits / lookups) if lookups else "",
+            )
+        )
+        for key in sorted(delta):
+            tty.debug("ccache {0}: {1:+d}".format(key, delta[key]))
+
+    @run_after("install")
+    def cache_benchmarks(self):
+        """Keep the benchmark inputs so ``spack test`` can run them."""
+        benchmark = self._amber_benchmark()
+        benchmarks = []
+        for system in self.benchmark_systems:
+            directory = join_path(self.stage.source_path, "benchmarks", system)
+            if os.path.isdir(directory) and benchmark.benchmark_inputs(directory):
+                benchmarks.append(join_path("benchmarks", system))
+            else:
+                tty.warn("No inputs found for the {0} benchmark".format(system))
+        if benchmarks:
+            self.cache_extra_test_sources(benchmarks)
 
-            # Openmp
-            if self.spec.satisfies("+openmp"):
-                make("clean")
-                conf(*(base_args + ["-openmp", compiler]))
-                make("openmp")
+    def _amber_benchmark(self):
+        """Import the amber_benchmark.py shipped alongside this package."""
+        path = join_path(os.path.dirname(__file__), "amber_benchmark.py")
+        module_spec = importlib.util.spec_from_file_location("amber_benchmark", path)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+        return module
 
-            # CUDA + MPI
-            if self.spec.satisfies("+cuda") and self.spec.satisfies("+mpi"):
-                make("clean")
-                conf(*(base_args + ["-cuda", "-mpi", compiler]))
-                make("install")
+    def _benchmark_commands(self):
+        """Return ``(label, ranks, command prefix)`` for the installed engines."""
+        commands = []
+        for engine in ("pmemd", "sander"):
+            exe = join_path(self.prefix.bin, engine)
+            if os.path.exists(exe):
+                commands.append((engine, 1, [exe]))
+            exe = join_path(self.prefix.bin, engine + ".MPI")
+            if self.spec.satisfies("+mpi") and os.path.exists(exe):
+                ranks = min(self.benchmark_ranks, os.cpu_count() or 1)
+                mpiexec = self.spec["mpi"].mpiexec
+                commands.append((engine + ".MPI", ranks, [mpiexec, "-n", str(ranks), exe]))
+        return commands
 
-            # just install everything that was built
-            install_tree(".", prefix)
+    def test(self):
+        """Check a relocated copy and run the shipped CPU benchmarks."""
+        self._test_relocation()
+        self._run_benchmarks()
+
+    def _relocate_copy(self, copy_root):
+        """Relocate a copy of the prefix the way a buildcache install does."""
+        prefixes = {self.prefix: copy_root}
+        text, binaries = [], []
+        for root, dirs, files in os.walk(copy_root):
+            for name in files + dirs:
+                path = join_path(root, name)
+                if os.path.islink(path):
+                    target = os.readlink(path)
+                    if target.startswith(self.prefix):
+                        os.remove(path)
+                        os.symlink(copy_root + target[len(self.prefix) :], path)
+                elif name in files:
+                    with open(path, "rb") as f:
+                        head = f.read(8192)
+                    if head.startswith(b"\x7fELF"):
+                        binaries.append(path)
+                    elif b"\0" not in head:
+                        text.append(path)
+        spack.relocate.relocate_text(text, prefixes)
+        spack.relocate.relocate_elf_binaries(
+            binaries, self.prefix, copy_root, prefixes, False, self.prefix, copy_root
+        )
+
+    def _test_relocation(self):
+        """Check that a relocated copy of the prefix loads and runs cpptraj.
+
+        The parts of the prefix in ``relocation_manifest`` are copied and
+        relocated like a buildcache install, leaving out the tests, examples
+        and benchmarks. The scripts are then sourced from the copy in a clean environment with
+        the original prefix hidden behind an empty mount, so that anything
+        still pointing at it fails.
+        """
+        if not os.path.exists(join_path(self.prefix, "amber.sh")):
+            return
+        relocated = join_path(os.getcwd(), "relocated-amber")
+        if os.path.exists(relocated):
+            shutil.rmtree(relocated)
+        files, written = _install_manifest(self.prefix, relocated, self.relocation_manifest)
+        tty.debug("Copied {0} files ({1}) to {2}".format(files, _human_size(written), relocated))
+        self._relocate_copy(relocated)
+
+        checks = [("bash", "source", "amber.sh")]
+        if which("tcsh"):
+            checks.append(("tcsh", "source", "amber.csh"))
+        empty = join_path(os.getcwd(), "hidden-prefix")
+        mkdirp(empty)
+        unshare = which("unshare")
+        hide = unshare and subprocess.call([unshare.path, "-rm", "true"]) == 0
+        if not hide:
+            tty.warn("Cannot hide {0} without unshare, it stays visible".format(self.prefix))
+
+        for shell, source, script in checks:
+            if not os.path.exists(join_path(relocated, script)):
+                continue
+            command = '{0} "{1}/{2}" && echo "AMBERHOME=$AMBERHOME" && cpptraj --version'.format(
+                source, relocated, script
+            )
+            clean = 'env -i HOME="$HOME" PATH=/usr/bin:/bin {0} -c {1}'.format(
+                shell, shlex.quote(command)
+            )
+            if hide:
+                exe, options = unshare.path, ["-rm", "sh", "-c"]
+                options.append(
+                    "mount --bind {0} {1} && exec {2}".format(
+                        shlex.quote(empty), shlex.quote(self.prefix), clean
+                    )
+                )
+            else:
+                exe, options = "sh", ["-c", clean]
+            self.run_test(
+                exe,
+                options=options,
+                expected=["AMBERHOME=" + re.escape(relocated), "[Vv]ersion"],
+                purpose="test: relocated {0} sets AMBERHOME and runs cpptraj".format(script),
+                installed=False,
+            )
+
+    def _run_benchmarks(self):
+        """Run the shipped CPU benchmarks and record their ns/day as JSON.
+
+        A benchmark whose inputs were not installed fails the test once the
+        others have run.
+        """
+        benchmark = self._amber_benchmark()
+        results, missing = [], []
+        for system in self.benchmark_systems:
+            source = join_path(self.test_suite.current_test_cache_dir, "benchmarks", system)
+            inputs = benchmark.benchmark_inputs(source) if os.path.isdir(source) else None
+            if inputs is None:
+                tty.warn("No inputs installed for the {0} benchmark".format(system))
+                missing.append(system)
+                continue
+            mdin, prmtop, inpcrd = inputs
+            namelist = re.sub(
+                r"nstlim\s*=\s*\d+", "nstlim={0}".format(self.benchmark_steps), mdin
+            )
+
+            for label, ranks, command in self._benchmark_commands():
+                workdir = join_path(os.getcwd(), "benchmark-{0}-{1}".format(system, label))
+                mkdirp(workdir)
+                with open(join_path(workdir, "mdin"), "w") as f:
+                    f.write(namelist)
+                options = [
+                    "-O",
+                    "-i",
+                    "mdin",
+                    "-p",
+                    benchmark.uncompressed(prmtop, workdir),
+                    "-c",
+                    benchmark.uncompressed(inpcrd, workdir),
+                    "-o",
+                    "mdout",
+                ]
+                passed = self.run_test(
+                    command[0],
+                    options=command[1:] + options,
+                    purpose="test: {0} benchmark with {1}".format(system, label),
+                    installed=False,
+                    work_dir=workdir,
+                )
+                # a failed run is recorded and the remaining runs still go ahead
+                result = {"status": "pass" if passed else "fail"}
+                try:
+                    with open(join_path(workdir, "mdout")) as f:
+                        result.update(benchmark.parse_mdout(f.read()))
+                except (IOError, OSError):
+                    result["status"] = "fail"
+                result.update({"system": system, "executable": label, "ranks": ranks})
+                results.append(result)
+
+        report = {
+            "spec": self.spec.format("{name}{@version}{%compiler}{variants}"),
+            "host": platform.node(),
+            "benchmarks": results,
+            "missing_inputs": missing,
+        }
+        filename = join_path(os.getcwd(), "amber-benchmark.json")
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+        for result in results:
+            tty.msg(
+                "{system} {executable} ({ranks} ranks, {status}): {0} ns/day".format(
+                    result.get("ns_per_day", "n/a"), **result
+                )
+            )
+        tty.msg("Benchmark results saved to {0}".format(filename))
+        if missing:
+            raise RuntimeError("Benchmark inputs not installed for {0}".format(", ".join(missing)))
+
+    @run_after("install")
+    @on_package_attributes(run_tests=True)
+    def run_regression_tests(self):
+        """Run Amber's installed regression tests concurrently.
+
+        The tests run in a copy of the installed test trees in the stage,
+        under an AMBERHOME linking everything else back to the prefix, so
+        that their outputs stay out of the installation. Test directories
+        run in parallel on ``make_jobs`` workers while the scripts of one
+        directory run in order, as they share their inputs and outputs.
+        Results are saved as JSON and JUnit XML.
+        """
+        trees = [
+            tree
+            for tree in ("test", join_path("AmberTools", "test"))
+            if os.path.isdir(join_path(self.prefix, tree))
+        ]
+        if not trees:
+            tty.warn("No Amber regression tests found in {0}".format(self.prefix))
+            return
+        amberhome = join_path(self.stage.path, "amber-tests")
+        if os.path.exists(amberhome):
+            shutil.rmtree(amberhome)
+        _shadow_tree(self.prefix, amberhome, trees)
+        tests = _find_regression_tests([join_path(amberhome, tree) for tree in trees])
+
+        env = dict(os.environ)
+        env.pop("DO_PARALLEL", None)
+        env.update(
+            {
+                "AMBERHOME": amberhome,
+                "PATH": os.pathsep.join([join_path(amberhome, "bin"), env.get("PATH", "")]),
+                "OMP_NUM_THREADS": "1",
+            }
+        )
+        timeout = float(os.environ.get("AMBER_TEST_TIMEOUT", self.regression_timeout))
+
+        def run_directory(scripts):
+            return [_run_regression_test(script, env, timeout) for script in scripts]
+
+        with ThreadPoolExecutor(max_workers=make_jobs) as executor:
+            results = [r for group in executor.map(run_directory, tests.values()) for r in group]
+
+        counts = {}
+        for result in results:
+            counts[result["status"]] = counts.get(result["status"], 0) + 1
+        filename = join_path(self.prefix, ".spack", "amber-tests.json")
+        with open(filename, "w") as f:
+            json.dump({"summary": counts, "tests": results}, f, indent=2)
+        _junit_report(results, join_path(self.prefix, ".spack", "amber-tests.xml"))
+
+        summary = ", ".join("{0} {1}".format(n, status) for status, n in sorted(counts.items()))
+        tty.msg("Amber regression tests: {0}".format(summary), "Report: {0}".format(filename))
+        failed = [r["test"] for r in results if r["status"] in ("diff", "fail", "timeout")]
+        if failed:
+            tty.warn("{0} Amber regression tests did not pass".format(len(failed)), *failed[:20])
+
+    def _install_runtime(self, prefix):
+        """Install the files of the selected install profile into ``prefix``."""
+        source_path = self.stage.source_path
+        link = self.spec.satisfies("+link_install")
+        manifest = list(self.install_manifest)
+        if not self.spec.satisfies("profile=runtime"):
+            manifest += self.test_manifest
+        if self.spec.satisfies("profile=full"):
+            manifest += self.example_manifest
+        files, written = _install_manifest(source_path, prefix, manifest, link)
+        total = _tree_size(source_path)
+        tty.msg(
+            "Installed {0} files ({1} written) out of a {2} build tree".format(
+                files, _human_size(written), _human_size(total)
+            )
+        )
+
+    def _legacy_flavors(self):
+        """Return the flavors built by the legacy configure, in build order.
+
+        Each entry is a ``(name, configure flags, make target, clean)`` tuple,
+        where ``clean`` tells whether objects left by the previous flavors
+        have to be removed first.
+        """
+        flavors = [("serial", [], "install", False)]
+        if self.spec.satisfies("+cuda"):
+            flavors.append(("cuda", ["-cuda"], "install", False))
+        if self.spec.satisfies("+mpi"):
+            flavors.append(("mpi", ["-mpi"], "install", False))
+        if self.spec.satisfies("+openmp"):
+            flavors.append(("openmp", ["-openmp"], "openmp", True))
+        if self.spec.satisfies("+cuda") and self.spec.satisfies("+mpi"):
+            flavors.append(("cuda_mpi", ["-cuda", "-mpi"], "install", True))
+        return flavors
+
+    def _build_legacy_flavors(self, flavors, base_args, compiler):
+        """Build ``flavors`` concurrently, each in its own copy of the tree.
+
+        The make job budget is split between the flavors. Once all of them
+        succeed, the programs and libraries they installed are merged back
+        into the source tree in the usual build order.
+        """
+        source_path = self.stage.source_path
+        jobs = max(1, make_jobs // len(flavors))
+
+        def build(flavor):
+            name, flags, target, clean = flavor
+            tree = join_path(self.stage.path, "amber-{0}".format(name))
+            log = join_path(source_path, "spack-build-{0}.log".format(name))
+            with self._phase("build {0}".format(name), [tree]) as record:
+                if os.path.exists(tree):
+                    shutil.rmtree(tree)
+                shutil.copytree(source_path, tree, symlinks=True)
+                env = dict(os.environ, AMBERHOME=tree)
+                if clean:
+                    _run_logged(["make", "clean"], tree, log, env, record)
+                configure = ["./configure"] + base_args + flags + [compiler]
+                _run_logged(configure, tree, log, env, record)
+                _run_logged(["make", "-j{0}".format(jobs), target], tree, log, env, record)
+            return tree
+
+        tty.msg(
+            "Building {0} concurrently with {1} jobs each".format(
+                ", ".join(f[0] for f in flavors), jobs
+            )
+        )
+        with ThreadPoolExecutor(max_workers=len(flavors)) as executor:
+            trees = list(executor.map(build, flavors))
+
+        with self._phase("merge flavors"):
+            for tree in trees:
+                for subdir in ("bin", "lib", "include"):
+                    if os.path.isdir(join_path(tree, subdir)):
+                        _replace_in_scripts(join_path(tree, subdir), tree, source_path)
+                        _merge_tree(join_path(tree, subdir), join_path(source_path, subdir))
+                shutil.rmtree(tree)
+
+    def _cmake_flavors(self):
+        """Return ``(name, configure_cmake.py flags)`` for the enabled flavors."""
+        flavors = [("serial", [])]
+        if self.spec.satisfies("+cuda"):
+            flavors.append(("cuda", ["--cuda"]))
+        if self.spec.satisfies("+mpi"):
+            flavors.append(("mpi", ["--mpi"]))
+        if self.spec.satisfies("+openmp"):
+            flavors.append(("openmp", ["--openmp"]))
+        if self.spec.satisfies("+cuda") and self.spec.satisfies("+mpi"):
+            flavors.append(("cuda_mpi", ["--cuda", "--mpi"]))
+        return flavors
+
+    def _configure_cmake(self):
+        """Import the configure_cmake.py maintained alongside this package."""
+        path = join_path(os.path.dirname(__file__), "configure_cmake.py")
+        module_spec = importlib.util.spec_from_file_location("amber_configure_cmake", path)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+        return module
+
+    def _build_cmake_flavors(self, base_args):
+        """Configure, build and install every flavor in its own build directory.
+
+        The cmake command line of every flavor is resolved in-process with
+        configure_cmake.py, then all configure steps run concurrently. The
+        shared src and AmberTools/src trees are cleaned once afterwards.
+        The builds overlap when +parallel_variants is set, sharing the make
+        job budget, while installs into the shared prefix are serialized.
+        """
+        configure_cmake = self._configure_cmake()
+        source_path = self.stage.source_path
+        cmake_exe = self.spec["cmake"].prefix.bin.cmake
+        workers = 1
+        if self.spec.satisfies("+parallel_variants"):
+            workers = len(self._cmake_flavors())
+        jobs = max(1, make_jobs // workers)
+        install_lock = threading.Lock()
+
+        configurations = []
+        for name, flags in self._cmake_flavors():
+            build_dir = join_path(source_path, "build-{0}".format(name))
+            log = join_path(source_path, "spack-build-{0}.log".format(name))
+            mkdirp(build_dir)
+            report = configure_cmake.CMakeLog(log)
+            args = configure_cmake.parse_args(base_args + flags + ["--source", source_path])
+            command = configure_cmake.configure(args, report)
+            report.close()
+            fingerprint = configure_cmake.fingerprint(command, source_path)
+            configurations.append((build_dir, log, [cmake_exe] + command[1:], fingerprint))
+
+        def configure(configuration):
+            build_dir, log, command, fingerprint = configuration
+            # A retry in the same stage keeps the unchanged configurations
+            if configure_cmake.is_configured(build_dir, fingerprint):
+                return False
+            configure_cmake.record_fingerprint(build_dir, None)
+            _run_logged(command, build_dir, log)
+            return True
+
+        def build(configuration):
+            # cmake --build drives make or ninja, whichever was generated
+            build_dir, log = configuration[:2]
+            name = os.path.basename(build_dir)[len("build-"):]
+            with self._phase("build {0}".format(name), [build_dir]) as record:
+                command = [cmake_exe, "--build", ".", "--", "-j{0}".format(jobs)]
+                _run_logged(command, build_dir, log, record=record)
+            with install_lock:
+                with self._phase("install {0}".format(name), [self.prefix]) as record:
+                    command = [cmake_exe, "--build", ".", "--target", "install"]
+                    _run_logged(command, build_dir, log, record=record)
+
+        # Consume the results so that a failed flavor raises here
+        with self._phase("configure"):
+            with ThreadPoolExecutor(max_workers=len(configurations)) as executor:
+                configured = list(executor.map(configure, configurations))
+
+        if any(configured):
+            build_dir, log = configurations[configured.index(True)][:2]
+            report = configure_cmake.CMakeLog(log, mode="a")
+            with self._phase("clean sources"):
+                returncode = configure_cmake.clean_sources(source_path, build_dir, report)
+            report.close()
+            if returncode != 0:
+                raise InstallError(
+                    "Cleaning the Amber source trees failed",
+                    "See {0} for the complete output".format(log),
+                )
+        for (build_dir, _, _, fingerprint), reconfigured in zip(configurations, configured):
+            if reconfigured:
+                configure_cmake.record_fingerprint(build_dir, fingerprint)
+            else:
+                tty.msg("{0} is already configured".format(build_dir))
+
+        tty.msg(
+            "Building {0} with {1} jobs each".format(
+                ", ".join(f[0] for f in self._cmake_flavors()), jobs
+            )
+        )
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(build, configurations))
 
     def setup_run_environment(self, env):
         env.set("AMBER_PREFIX", self.prefix)
@@ -301,4 +1617,41 @@ class Amber(Package, CudaPackage):
         # does this exist in amber <22?
         filename = os.path.join(self.prefix, "amber.sh")
         if os.path.exists(filename):
-            env.extend(EnvironmentModifications.from_sourcing_file(filename))
+            cache_file = join_path(self.prefix, self.env_cache)
+            modifications = _load_env_modifications(filename, cache_file, self.prefix)
+            if modifications is None:
+                # Loads only read the cache, cache_run_environment writes it
+                modifications = EnvironmentModifications.from_sourcing_file(filename)
+            env.extend(modifications)
+
+    @run_after("install")
+    def install_launcher(self):
+        """Install amber-launch, which pins OpenMP threads for each MPI rank."""
+        launcher = join_path(self.prefix.bin, "amber-launch")
+        mkdirp(self.prefix.bin)
+        copy(join_path(os.path.dirname(__file__), "amber_launch.py"), launcher)
+        if self.spec.satisfies("@22:"):
+            filter_file(
+                "^#!/usr/bin/env python3$", "#!" + self.spec["python"].command.path, launcher
+            )
+        set_executable(launcher)
+
+    @run_after("install")
+    def make_relocatable(self):
+        """Make amber.sh and amber.csh independent of the install prefix."""
+        for name in _relocatable_scripts:
+            filename = join_path(self.prefix, name)
+            if os.path.exists(filename) and not _make_relocatable(filename, self.prefix):
+                tty.warn("{0} does not set AMBERHOME, leaving it as installed".format(name))
+
+    @run_after("install")
+    def cache_run_environment(self):
+        """Source amber.sh once and store the resulting modifications."""
+        filename = join_path(self.prefix, "amber.sh")
+        if not os.path.exists(filename):
+            return
+        modifications = EnvironmentModifications.from_sourcing_file(filename)
+        if not _dump_env_modifications(
+            modifications, filename, join_path(self.prefix, self.env_cache), self.prefix
+        ):
+            tty.warn("amber.sh sets the environment in a way that cannot be cached")
@@ -0,0 +1,132 @@
+"""Tests of amber_benchmark.py with pmemd/sander outputs and benchmark trees."""
+
+import gzip
+import os
+
+import pytest
+
+import amber_benchmark
+
+_cntrl = """\
+Ewald parameters:
+     verbose =       0, ew_type =       0, nbflag  =       1, use_pme =       1
+Molecular dynamics:
+     nstlim  =      1000, nscm    =         0, nrespa  =         1
+     t       =   0.00000, dt      =   0.00200, vlimit  =  -1.00000
+"""
+
+_pmemd_mdout = (
+    _cntrl
+    + """\
+|     Average timings for last     500 steps:
+|     Elapsed(s) =       9.10 Per Step(ms) =      18.20
+|         ns/day =       9.49   seconds/ns =    9100.00
+|
+|     Average timings for all steps:
+|     Elapsed(s) =      18.00 Per Step(ms) =      18.00
+|         ns/day =       9.60   seconds/ns =    9000.00
+|  Master Setup CPU time:            0.50 seconds
+|  Master Total wall time:          19    seconds     0.01 hours
+"""
+)
+
+_sander_mdout = (
+    _cntrl
+    + """\
+|  Setup CPU time:            0.05 seconds
+|  NonSetup CPU time:        35.90 seconds
+|  Total CPU time:           35.95 seconds     0.01 hours
+|  Setup wall time:           0    seconds
+|  NonSetup wall time:       36    seconds
+|  Total wall time:          36    seconds     0.01 hours
+"""
+)
+
+_bench_jac = """\
+#!/bin/sh
+
+sander="$AMBERHOME/bin/sander"
+
+cat <<eof > mdin
+ short md, nve ensemble
+ &cntrl
+   ntx=7, irest=1,
+   nstlim=1000, dt=0.001,
+ &end
+eof
+
+rm -f mdout.jac
+$DO_PARALLEL $sander -O -i mdin -c inpcrd.equil \\
+    -o mdout.jac < /dev/null || error
+"""
+
+
+def test_parse_pmemd_mdout():
+    assert amber_benchmark.parse_mdout(_pmemd_mdout) == {
+        "steps": 1000,
+        "dt_ps": 0.002,
+        "wall_seconds": 19.0,
+        "ns_per_day": 9.6,
+    }
+
+
+def test_parse_sander_mdout():
+    # 1000 steps of 2 fs in 36 s
+    result = amber_benchmark.parse_mdout(_sander_mdout)
+    assert result["wall_seconds"] == 36.0
+    assert result["ns_per_day"] == pytest.approx(4.8)
+
+
+def test_parse_incomplete_mdout():
+    assert "ns_per_day" not in amber_benchmark.parse_mdout(_cntrl)
+    assert amber_benchmark.parse_mdout("") == {}
+
+
+def test_parse_bench_script():
+    mdin, prmtop, inpcrd = amber_benchmark.parse_bench_script(_bench_jac)
+    assert mdin.startswith(" short md, nve ensemble\n &cntrl\n")
+    assert "nstlim=1000" in mdin and "eof" not in mdin
+    assert (prmtop, inpcrd) == ("prmtop", "inpcrd.equil")
+
+
+def test_parse_bench_script_without_namelist():
+    assert amber_benchmark.parse_bench_script("$sander -O -i mdin -o mdout\n") is None
+
+
+def _write(path, text):
+    with open(str(path), "w") as f:
+        f.write(text)
+
+
+def test_inputs_from_bench_script(tmp_path):
+    _write(tmp_path / "bench.jac", _bench_jac)
+    _write(tmp_path / "prmtop", "topology\n")
+    with gzip.open(str(tmp_path / "inpcrd.equil.gz"), "wt") as f:
+        f.write("coordinates\n")
+    mdin, prmtop, inpcrd = amber_benchmark.benchmark_inputs(str(tmp_path))
+    assert "&cntrl" in mdin
+    assert prmtop == str(tmp_path / "prmtop")
+    assert inpcrd == str(tmp_path / "inpcrd.equil.gz")
+
+    work = tmp_path / "work"
+    work.mkdir()
+    plain = amber_benchmark.uncompressed(inpcrd, str(work))
+    assert plain == str(work / "inpcrd.equil")
+    with open(plain) as f:
+        assert f.read() == "coordinates\n"
+    assert amber_benchmark.uncompressed(prmtop, str(work)) == prmtop
+
+
+def test_inputs_from_files(tmp_path):
+    for name in ("mdin", "prmtop", "inpcrd"):
+        _write(tmp_path / name, name + "\n")
+    assert amber_benchmark.benchmark_inputs(str(tmp_path)) == (
+        "mdin\n",
+        os.path.join(str(tmp_path), "prmtop"),
+        os.path.join(str(tmp_path), "inpcrd"),
+    )
+
+
+def test_inputs_missing(tmp_path):
+    _write(tmp_path / "bench.jac", _bench_jac)
+    assert amber_benchmark.benchmark_inputs(str(tmp_path)) is None
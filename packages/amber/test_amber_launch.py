@@ -0,0 +1,242 @@
+"""Tests of amber_launch.py against fake sysfs and procfs trees."""
+
+import os
+
+import pytest
+
+import amber_launch
+
+
+def _write(path, text):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+@pytest.fixture
+def dual_socket(tmp_path):
+    """Two NUMA domains of 4 cores with 2 hardware threads each.
+
+    CPU ``i`` is thread ``i // 8`` of core ``i % 4`` on socket ``(i % 8) // 4``.
+    """
+    root = str(tmp_path / "sys")
+    cpu_root = os.path.join(root, "devices", "system", "cpu")
+    _write(os.path.join(cpu_root, "online"), "0-15\n")
+    for cpu in range(16):
+        topology = os.path.join(cpu_root, "cpu{0}".format(cpu), "topology")
+        _write(os.path.join(topology, "physical_package_id"), str((cpu % 8) // 4))
+        _write(os.path.join(topology, "core_id"), str(cpu % 4))
+    for node in range(2):
+        _write(
+            os.path.join(root, "devices", "system", "node", "node{0}".format(node), "cpulist"),
+            "{0}-{1},{2}-{3}\n".format(4 * node, 4 * node + 3, 8 + 4 * node, 8 + 4 * node + 3),
+        )
+    return root
+
+
+@pytest.fixture
+def cpuinfo_only(tmp_path):
+    """A /proc/cpuinfo with 2 sockets of 2 cores and no sysfs topology."""
+    blocks = []
+    for cpu in range(4):
+        blocks.append(
+            "processor\t: {0}\nphysical id\t: {1}\ncore id\t: {2}\n".format(cpu, cpu // 2, cpu % 2)
+        )
+    _write(str(tmp_path / "proc" / "cpuinfo"), "\n".join(blocks))
+    return str(tmp_path / "nosys"), str(tmp_path / "proc")
+
+
+@pytest.mark.parametrize(
+    "text,cpus",
+    [
+        ("0", [0]),
+        ("0-3", [0, 1, 2, 3]),
+        ("0-1,8,10-11\n", [0, 1, 8, 10, 11]),
+        ("", []),
+    ],
+)
+def test_parse_cpulist(text, cpus):
+    assert amber_launch.parse_cpulist(text) == cpus
+
+
+def test_detect_sysfs(dual_socket):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent")
+    assert topology.domains == [
+        [[0, 8], [1, 9], [2, 10], [3, 11]],
+        [[4, 12], [5, 13], [6, 14], [7, 15]],
+    ]
+
+
+def test_detect_sysfs_allowed(dual_socket):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent", {4, 5, 12, 13})
+    assert topology.domains == [[[4, 12], [5, 13]]]
+
+
+def test_detect_cpuinfo(cpuinfo_only):
+    topology = amber_launch.Topology.detect(*cpuinfo_only)
+    assert topology.domains == [[[0], [1]], [[2], [3]]]
+
+
+def test_detect_nothing(tmp_path):
+    with pytest.raises(RuntimeError):
+        amber_launch.Topology.detect(str(tmp_path / "sys"), str(tmp_path / "proc"))
+
+
+def _domain_of(topology, core):
+    return next(i for i, domain in enumerate(topology.domains) if core in domain)
+
+
+@pytest.mark.parametrize("ranks", [1, 2, 3, 4, 5, 6, 8])
+def test_layout_uses_every_core_once(dual_socket, ranks):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent")
+    layout = topology.layout(ranks)
+    assert len(layout) == ranks
+    assert sorted(c[0] for cores in layout for c in cores) == sorted(
+        c[0] for c in topology.cores
+    )
+
+
+@pytest.mark.parametrize("ranks", [2, 3, 4, 5, 6, 8])
+def test_layout_does_not_straddle_domains(dual_socket, ranks):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent")
+    for cores in topology.layout(ranks):
+        assert len(set(_domain_of(topology, core) for core in cores)) == 1
+
+
+def test_layout_divisible(dual_socket):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent")
+    assert [len(cores) for cores in topology.layout(4)] == [2, 2, 2, 2]
+
+
+def test_layout_not_divisible(dual_socket):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent")
+    layout = topology.layout(3)
+    assert [len(cores) for cores in layout] == [2, 2, 4]
+    assert layout[2] == topology.domains[1]
+
+
+def test_layout_fewer_ranks_than_domains(cpuinfo_only):
+    topology = amber_launch.Topology.detect(*cpuinfo_only)
+    assert topology.layout(1) == [[[0], [1], [2], [3]]]
+
+
+def test_layout_too_many_ranks(dual_socket):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent")
+    with pytest.raises(ValueError):
+        topology.layout(9)
+
+
+def test_fit_splits_hardware_threads(dual_socket):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent")
+    assert amber_launch.fit(topology, 8) is topology
+    layout = amber_launch.fit(topology, 16).layout(16)
+    assert sorted(t for cores in layout for [t] in cores) == list(range(16))
+    with pytest.raises(ValueError):
+        amber_launch.fit(topology, 17)
+
+
+def test_plan_more_ranks_than_cores(dual_socket):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent", {4, 5, 12, 13})
+    assert amber_launch.plan(topology, 3, 4) == ([[13]], 4)
+
+
+def test_omp_environment():
+    assert amber_launch.omp_environment([[0, 8], [1, 9]]) == {
+        "OMP_NUM_THREADS": "2",
+        "OMP_PLACES": "{0,8},{1,9}",
+        "OMP_PROC_BIND": "close",
+    }
+    assert amber_launch.omp_environment([[0, 8]], smt=True)["OMP_PLACES"] == "{0},{8}"
+
+
+@pytest.mark.parametrize(
+    "environ,expected",
+    [
+        ({}, (0, 1)),
+        ({"OMPI_COMM_WORLD_LOCAL_RANK": "1", "OMPI_COMM_WORLD_LOCAL_SIZE": "4"}, (1, 4)),
+        ({"MPI_LOCALRANKID": "2", "MPI_LOCALNRANKS": "3"}, (2, 3)),
+        ({"SLURM_LOCALID": "0", "SLURM_NTASKS_PER_NODE": "2"}, (0, 2)),
+        ({"SLURM_LOCALID": "1", "SLURM_STEP_TASKS_PER_NODE": "2(x3)"}, (1, 2)),
+        (
+            {
+                "SLURM_LOCALID": "0",
+                "SLURM_NODEID": "2",
+                "SLURM_STEP_TASKS_PER_NODE": "4(x2),3",
+                "SLURM_TASKS_PER_NODE": "4(x3)",
+            },
+            (0, 3),
+        ),
+        ({"SLURM_LOCALID": "0", "SLURM_TASKS_PER_NODE": "8"}, (0, 8)),
+        ({"SLURM_LOCALID": "0", "SLURM_TASKS_PER_NODE": "garbage"}, (0, 1)),
+    ],
+)
+def test_local_rank(environ, expected):
+    assert amber_launch.local_rank(environ) == expected
+
+
+@pytest.mark.parametrize(
+    "environ,bound",
+    [
+        ({}, False),
+        ({"SLURM_CPU_BIND_TYPE": "none"}, False),
+        ({"SLURM_CPU_BIND_TYPE": "mask_cpu:"}, True),
+        ({"OMPI_MCA_hwloc_base_binding_policy": "core"}, True),
+    ],
+)
+def test_launcher_bound(environ, bound):
+    assert amber_launch.launcher_bound(environ) == bound
+
+
+def _fake_ranks(tmp_path, masks):
+    """Create a launcher process 100 with one child rank per mask."""
+    proc = tmp_path / "proc"
+    children = " ".join(str(200 + i) for i in range(len(masks)))
+    _write(str(proc / "100" / "task" / "100" / "children"), children + "\n")
+    for i, mask in enumerate(masks):
+        pid = str(200 + i)
+        _write(str(proc / pid / "stat"), "{0} (pmemd MPI) S 100 1 1\n".format(pid))
+        _write(str(proc / pid / "status"), "Name:\tpmemd\nCpus_allowed_list:\t{0}\n".format(mask))
+    return str(proc)
+
+
+def test_siblings_bound(tmp_path):
+    proc = _fake_ranks(tmp_path, ["0-3", "4-7"])
+    assert amber_launch.siblings_bound(proc, 200)
+
+
+def test_siblings_share_cpuset(tmp_path):
+    proc = _fake_ranks(tmp_path, ["0-7", "0-7"])
+    assert not amber_launch.siblings_bound(proc, 200)
+
+
+def test_plan_splits_shared_cpus(dual_socket):
+    # a cpuset of one socket shared by two unbound ranks
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent", set(range(4, 8)))
+    assert amber_launch.plan(topology, 0, 2) == ([[4], [5]], 2)
+    assert amber_launch.plan(topology, 1, 2) == ([[6], [7]], 2)
+
+
+def test_plan_bound_rank_keeps_its_cpus(dual_socket):
+    topology = amber_launch.Topology.detect(dual_socket, "/nonexistent", set(range(4, 8)))
+    assert amber_launch.plan(topology, 1, 2, bound=True) == ([[4], [5], [6], [7]], 1)
+
+
+@pytest.mark.parametrize(
+    "text,counts",
+    [("4", [4]), ("2(x3)", [2, 2, 2]), ("4(x2),3", [4, 4, 3]), ("4(x", [])],
+)
+def test_parse_tasks_per_node(text, counts):
+    assert amber_launch.parse_tasks_per_node(text) == counts
+
+
+def test_print_oversubscribed(dual_socket, capsys):
+    assert amber_launch.main(["--sysfs-root", dual_socket, "--ranks", "17", "--print"], {}) == 0
+    out = capsys.readouterr().out
+    assert "17 ranks do not fit on 16 hardware threads, running unpinned" in out
+
+
+def test_print(dual_socket, capsys):
+    assert amber_launch.main(["--sysfs-root", dual_socket, "--ranks", "2", "--print"], {}) == 0
+    out = capsys.readouterr().out
+    assert "8 cores in 2 NUMA domains, 2 ranks" in out
+    assert "{4,12},{5,13},{6,14},{7,15}" in out
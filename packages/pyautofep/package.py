@@ -21,7 +21,59 @@
 # ----------------------------------------------------------------------------
 
 from spack.package import *
+import glob
+import hashlib
+import json
 import os
+import platform
+import shutil
+import tempfile
+import zipfile
+from urllib.parse import urlparse
+
+import llnl.util.tty as tty
+
+import spack.caches
+
+
+# conda platform subdirs by (system, machine)
+_conda_subdirs = {
+    ("Linux", "x86_64"): "linux-64",
+    ("Linux", "aarch64"): "linux-aarch64",
+    ("Linux", "ppc64le"): "linux-ppc64le",
+    ("Darwin", "x86_64"): "osx-64",
+    ("Darwin", "arm64"): "osx-arm64",
+}
+
+
+def _conda_subdir():
+    key = (platform.system(), platform.machine())
+    return _conda_subdirs.get(key, "{0}-{1}".format(*key).lower())
+
+
+def _sha256(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _lock_digest(filename):
+    """Return the yml hash recorded in the first line of a lock file."""
+    try:
+        with open(filename) as f:
+            first = f.readline()
+    except (IOError, OSError):
+        return None
+    if first.startswith("# yml-sha256:"):
+        return first.split(":", 1)[1].strip()
+    return None
+
+
+def _mirror_url(line, mirror):
+    """Point a package URL of an explicit lock at ``mirror``."""
+    url = urlparse(line)
+    if url.scheme not in ("http", "https"):
+        return line
+    return mirror.rstrip("/") + url._replace(scheme="", netloc="").geturl()
 
 
 class Pyautofep(Package):
@@ -44,11 +96,150 @@ class Pyautofep(Package):
         type=("build"),
     )
 
+    @classmethod
+    def env_file(cls, version):
+        return os.path.join(os.path.dirname(__file__), "pyautofep-{0}.yml".format(version))
+
+    @classmethod
+    def lock_files(cls, version, subdir=None):
+        """Explicit conda lock and pip pins kept next to the yml.
+
+        Both are specific to a conda platform subdir such as linux-64 and
+        record the sha256 of the yml they were solved from.
+        """
+        subdir = subdir or _conda_subdir()
+        base = os.path.join(
+            os.path.dirname(__file__), "pyautofep-{0}-{1}".format(version, subdir)
+        )
+        return base + ".lock", base + "-pip.txt"
+
+    @classmethod
+    def cached_lock_files(cls, version, subdir=None):
+        """Lock files solved by an install when none is kept next to the yml.
+
+        They live in PYAUTOFEP_LOCK_DIR, or Spack's misc cache, under a name
+        carrying the hash of the yml, so each edit of the yml is solved once.
+        """
+        subdir = subdir or _conda_subdir()
+        cache = os.environ.get("PYAUTOFEP_LOCK_DIR") or os.path.join(
+            spack.caches.misc_cache.root, "pyautofep-locks"
+        )
+        base = os.path.join(
+            cache,
+            "pyautofep-{0}-{1}-{2}".format(version, subdir, _sha256(cls.env_file(version))[:16]),
+        )
+        return base + ".lock", base + "-pip.txt"
+
+    @classmethod
+    def update_lock(cls, version, mamba):
+        """Solve the yml of ``version`` and write the lock files next to it.
+
+        It needs network access to the channels. Run it with ``spack python``
+        on each platform, then commit the lock files::
+
+            import spack.repo
+            pkg = spack.repo.path.get_pkg_class("pyautofep")
+            pkg.update_lock("2022.10.20", "/path/to/mambaforge/bin/mamba")
+        """
+        cls._solve(cls.env_file(version), mamba, *cls.lock_files(version))
+
+    @classmethod
+    def _solve(cls, env_file, mamba, lock, pip_lock):
+        """Solve ``env_file`` in a scratch env and record what it installed."""
+        mamba = Executable(mamba)
+        conda = Executable(os.path.join(os.path.dirname(mamba.path), "conda"))
+        header = "# yml-sha256: {0}\n".format(_sha256(env_file))
+
+        scratch = tempfile.mkdtemp(prefix="pyautofep-lock-")
+        try:
+            env = os.path.join(scratch, "env")
+            tty.msg("Solving {0}".format(env_file))
+            mamba("env", "create", "-p", env, "-f", env_file)
+            explicit = conda("list", "-p", env, "--explicit", "--md5", output=str)
+            exported = json.loads(conda("env", "export", "-p", env, "--json", output=str))
+        finally:
+            shutil.rmtree(scratch, ignore_errors=True)
+        pip = []
+        for dependency in exported.get("dependencies", []):
+            if isinstance(dependency, dict):
+                pip.extend(dependency.get("pip", []))
+
+        mkdirp(os.path.dirname(lock))
+        # the lock is renamed last, so a partial write is never picked up
+        with open(pip_lock + ".tmp", "w") as f:
+            f.write(header + "".join(line + "\n" for line in pip))
+        with open(lock + ".tmp", "w") as f:
+            f.write(header + explicit)
+        os.rename(pip_lock + ".tmp", pip_lock)
+        os.rename(lock + ".tmp", lock)
+        tty.msg("Wrote {0} and {1}".format(lock, pip_lock))
+
+    def _current_lock(self):
+        """Return the lock files to install from, solving the yml if needed.
+
+        The lock kept next to the yml is used when it was solved from it.
+        Otherwise the yml is solved once by the first install and the result
+        is cached for the following ones.
+        """
+        env_file = self.env_file(self.version)
+        digest = _sha256(env_file)
+        for lock, pip_lock in (
+            self.lock_files(self.version),
+            self.cached_lock_files(self.version),
+        ):
+            if _lock_digest(lock) == digest and _lock_digest(pip_lock) == digest:
+                return lock, pip_lock
+        lock, pip_lock = self.cached_lock_files(self.version)
+        tty.warn(
+            "No lock for {0} on {1}, solving it into {2}".format(
+                os.path.basename(env_file), _conda_subdir(), os.path.dirname(lock)
+            ),
+            "Commit a lock made with Pyautofep.update_lock() for reproducible installs",
+        )
+        self._solve(env_file, self.spec["mambaforge"].prefix.bin.mamba, lock, pip_lock)
+        return lock, pip_lock
+
     def install(self, spec, prefix):
-        mkdirp(prefix)
-        pkgname = "pyautofep-{0}".format(self.version)
-        env_file = os.path.join(os.path.dirname(__file__), "{0}.yml".format(pkgname))
-        sh = which("sh")
-        sh("mamba", "env", "create", "-p", prefix, "-f", env_file)
-        sh("chmod 777 *py")
-        sh("cp", "-rf", "./*", "{0}/bin".format(prefix))
+        lock, pip_lock = self._current_lock()
+
+        # PYAUTOFEP_CHANNEL_MIRROR, e.g. file:///srv/conda, replaces the
+        # scheme and host of every channel in the lock, so that
+        # https://repo.anaconda.com/pkgs/main/linux-64/x.conda is read from
+        # file:///srv/conda/pkgs/main/linux-64/x.conda
+        explicit = os.path.join(self.stage.path, os.path.basename(lock))
+        with open(lock) as f:
+            lines = f.read().splitlines()
+        mirror = os.environ.get("PYAUTOFEP_CHANNEL_MIRROR")
+        if mirror:
+            lines = [_mirror_url(line, mirror) for line in lines]
+        with open(explicit, "w") as f:
+            f.write("\n".join(lines) + "\n")
+
+        mamba = Executable(spec["mambaforge"].prefix.bin.mamba)
+        mamba("create", "-y", "-p", prefix, "--file", explicit)
+        with open(pip_lock) as f:
+            pins = [line for line in f if line.strip() and not line.startswith("#")]
+        if pins:
+            # PYAUTOFEP_PIP_FIND_LINKS installs the pins from a local wheel
+            # directory instead of PyPI
+            args = ["-m", "pip", "install", "--no-deps", "-r", pip_lock]
+            find_links = os.environ.get("PYAUTOFEP_PIP_FIND_LINKS")
+            if find_links:
+                args += ["--no-index", "--find-links", find_links]
+            python = Executable(prefix.bin.python)
+            python(*args)
+
+        # keep the lock that produced this environment with it
+        mkdirp(join_path(prefix, ".spack"))
+        shutil.copy(lock, join_path(prefix, ".spack", "pyautofep.lock"))
+        shutil.copy(pip_lock, join_path(prefix, ".spack", "pyautofep-pip.txt"))
+
+        # install the PyAutoFEP scripts from the unexpanded zip
+        sources = os.path.join(self.stage.path, "pyautofep-src")
+        for filename in glob.glob(os.path.join(self.stage.source_path, "*.zip")):
+            with zipfile.ZipFile(filename) as archive:
+                archive.extractall(sources)
+        for script in glob.glob(os.path.join(sources, "*", "*.py")):
+            target = join_path(prefix.bin, os.path.basename(script))
+            shutil.copy(script, target)
+            set_executable(target)
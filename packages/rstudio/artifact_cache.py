@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""Content-addressed download cache for the RStudio dependency installers.
+
+Files are stored under ``blobs/`` by the sha256 of their contents, and
+``index.json`` maps every URL fetched so far to its blob. A URL is looked up
+in the index first, then in the mirror, by file name, and only then
+downloaded. Blobs are opened while holding the lock and copied out of the
+cache, so installers are free to modify or delete what they unpack, and a
+blob evicted by a concurrent installer stays readable until it is closed.
+
+The least recently used blobs are evicted once the cache grows beyond its
+maximum size. Concurrent installers share the cache through a lock file.
+
+    artifact_cache.py fetch URL [OUTPUT]
+
+Environment:
+
+    RSTUDIO_ARTIFACT_CACHE          cache directory (required)
+    RSTUDIO_ARTIFACT_CACHE_MAXSIZE  maximum size, e.g. 10G (default: 10G)
+    RSTUDIO_ARTIFACT_MIRROR         directory or file:// URL with the artifacts
+    RSTUDIO_ARTIFACT_TIMEOUT        network timeout in seconds (default: 60)
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from urllib.parse import unquote, urlparse
+from urllib.request import urlopen
+
+_units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30, "T": 1 << 40}
+
+
+def parse_size(text):
+    """Parse a size such as ``512M`` or ``10G`` into bytes."""
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in _units:
+        return int(float(text[:-1]) * _units[text[-1]])
+    return int(text)
+
+
+def _sha256(filename):
+    digest = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ArtifactCache(object):
+    def __init__(self, root, max_size=10 << 30, mirror=None, timeout=60):
+        self.root = root
+        self.blobs = os.path.join(root, "blobs")
+        self.index_file = os.path.join(root, "index.json")
+        self.max_size = max_size
+        if mirror and mirror.startswith("file://"):
+            mirror = unquote(urlparse(mirror).path)
+        self.mirror = mirror
+        self.timeout = timeout
+        if not os.path.isdir(self.blobs):
+            os.makedirs(self.blobs)
+
+    @contextlib.contextmanager
+    def lock(self):
+        with open(os.path.join(self.root, ".lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _load_index(self):
+        try:
+            with open(self.index_file) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _save_index(self, index):
+        tmp = self.index_file + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.index_file)
+
+    def _blob(self, digest):
+        return os.path.join(self.blobs, digest)
+
+    def lookup(self, url):
+        """Return the cached blob for ``url`` opened for reading, or None.
+
+        The blob is opened under the lock, so it remains readable through the
+        returned file even if another installer evicts it afterwards.
+        """
+        with self.lock():
+            digest = self._load_index().get(url)
+            if not digest:
+                return None
+            try:
+                f = open(self._blob(digest), "rb")
+            except (IOError, OSError):
+                return None
+            os.utime(self._blob(digest), None)
+        return f
+
+    def add(self, url, filename):
+        """Move ``filename``, the contents of ``url``, into the cache."""
+        digest = _sha256(filename)
+        with self.lock():
+            if os.path.exists(self._blob(digest)):
+                os.remove(filename)
+                os.utime(self._blob(digest), None)
+            else:
+                os.rename(filename, self._blob(digest))
+            index = self._load_index()
+            index[url] = digest
+            self._save_index(index)
+            self.evict(index, keep=digest)
+        return self._blob(digest)
+
+    def evict(self, index, keep=None):
+        """Remove the least recently used blobs beyond ``max_size``."""
+        blobs = []
+        for name in os.listdir(self.blobs):
+            st = os.stat(self._blob(name))
+            blobs.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in blobs)
+        evicted = set()
+        for _, size, name in sorted(blobs):
+            if total <= self.max_size:
+                break
+            if name == keep:
+                continue
+            os.remove(self._blob(name))
+            evicted.add(name)
+            total -= size
+        if evicted:
+            for url in [url for url, digest in index.items() if digest in evicted]:
+                del index[url]
+            self._save_index(index)
+
+    def _download(self, url):
+        """Fetch ``url`` from the mirror or the network into a temporary file."""
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=".download-")
+        with os.fdopen(fd, "wb") as out:
+            local = None
+            if self.mirror:
+                local = os.path.join(self.mirror, os.path.basename(urlparse(url).path))
+            if local and os.path.isfile(local):
+                with open(local, "rb") as f:
+                    shutil.copyfileobj(f, out)
+            else:
+                response = urlopen(url, timeout=self.timeout)
+                try:
+                    shutil.copyfileobj(response, out)
+                finally:
+                    response.close()
+        return tmp
+
+    def fetch(self, url, output):
+        """Copy the contents of ``url`` to ``output``; True on a cache hit."""
+        blob = self.lookup(url)
+        if blob is not None:
+            with blob, open(output, "wb") as out:
+                shutil.copyfileobj(blob, out)
+            return True
+        tmp = self._download(url)
+        try:
+            # copy before adding, the blob may be evicted as soon as it is in
+            shutil.copyfile(tmp, output)
+            self.add(url, tmp)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return False
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) not in (2, 3) or argv[0] != "fetch":
+        sys.stderr.write("usage: artifact_cache.py fetch URL [OUTPUT]\n")
+        return 2
+    url = argv[1]
+    output = argv[2] if len(argv) == 3 else os.path.basename(urlparse(url).path)
+    cache = ArtifactCache(
+        os.environ["RSTUDIO_ARTIFACT_CACHE"],
+        parse_size(os.environ.get("RSTUDIO_ARTIFACT_CACHE_MAXSIZE", "10G")),
+        os.environ.get("RSTUDIO_ARTIFACT_MIRROR"),
+        float(os.environ.get("RSTUDIO_ARTIFACT_TIMEOUT", "60")),
+    )
+    start = time.time()
+    try:
+        hit = cache.fetch(url, output)
+    except Exception as e:
+        sys.stderr.write("artifact_cache.py: {0}: {1}\n".format(url, e))
+        return 1
+    sys.stderr.write(
+        "artifact_cache.py: {0} {1} ({2:.1f}s)\n".format(
+            "hit" if hit else "fetched", url, time.time() - start
+        )
+    )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,10 +3,145 @@
 #
 # SPDX-License-Identifier: (Apache-2.0 OR MIT)
 
+import contextlib
+import getpass
+import hashlib
+import importlib.util
+import json
 import os
+import shutil
+import socket
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
 
+import llnl.util.tty as tty
+
+import spack.caches
 from spack.package import *
 
+# Appended to rstudio-tools.sh so that the dependency installers download
+# through artifact_cache.py
+_download_override = """
+# Added by Spack: fetch through the shared artifact cache
+download () {{
+    "{python}" "{tool}" fetch "$@"
+}}
+"""
+
+
+# Writes the DESCRIPTION index of the merged site library, in the format
+# installed.packages() caches it in, to the file given as second argument
+_index_script = """\
+args <- commandArgs(TRUE)
+lib <- normalizePath(args[1], "/")
+fields <- utils:::.instPkgFields(NULL)
+saveRDS(
+    list(base = paste(c(lib, fields), collapse = ","), value = utils:::.readPkgDesc(lib, fields)),
+    args[2]
+)
+"""
+
+# R_PROFILE of RStudio sessions. It runs the site profile of R, then seeds
+# the per-session installed.packages() cache with the precomputed index, so
+# neither R nor the RStudio packages pane reads the DESCRIPTION of every
+# package at startup. Any mismatch, e.g. another R version, leaves the cache
+# alone and R reads the library as usual.
+_site_profile = """\
+# Generated by Spack for RStudio
+local({
+    site <- file.path(R.home("etc"), "Rprofile.site")
+    if (file.exists(site)) sys.source(site, envir = baseenv())
+})
+local(tryCatch({
+    index <- readRDS("@INDEX@")
+    base <- paste(
+        c(normalizePath("@SITE@", "/"), utils:::.instPkgFields(NULL)),
+        collapse = ","
+    )
+    if (identical(index$base, base)) {
+        enc <- sprintf("%d_%s", nchar(base), .Call(utils:::C_crc64, base))
+        saveRDS(index, file.path(tempdir(), paste0("libloc_", enc, ".rds")))
+    }
+}, error = function(e) NULL))
+"""
+
+
+def _free_port():
+    """Return a loopback TCP port that is free at the time of the call."""
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _get(url, timeout=10):
+    """Request ``url`` and return its HTTP status, following no redirects."""
+
+    class NoRedirect(urllib.request.HTTPRedirectHandler):
+        def redirect_request(self, *args, **kwargs):
+            return None
+
+    try:
+        with urllib.request.build_opener(NoRedirect).open(url, timeout=timeout) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def _wait_ready(process, url, timeout):
+    """Poll ``url`` until it answers and return the seconds it took."""
+    start = time.time()
+    while time.time() - start < timeout:
+        if process.poll() is not None:
+            raise InstallError(
+                "{0} exited with code {1}".format(process.args[0], process.returncode)
+            )
+        try:
+            _get(url, timeout=1)
+            return time.time() - start
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.05)
+    raise InstallError("{0} did not answer within {1}s".format(url, timeout))
+
+
+def _rss_kb(pid):
+    """Resident memory of ``pid`` and its descendants in kB."""
+    total = 0
+    try:
+        with open("/proc/{0}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    total += int(line.split()[1])
+        for task in os.listdir("/proc/{0}/task".format(pid)):
+            with open("/proc/{0}/task/{1}/children".format(pid, task)) as f:
+                total += sum(_rss_kb(int(child)) for child in f.read().split())
+    except (IOError, OSError):
+        pass
+    return total
+
+
+def _latency(url, requests):
+    """Time ``requests`` sequential requests to ``url`` in milliseconds."""
+    samples = []
+    for _ in range(requests):
+        start = time.time()
+        status = _get(url)
+        samples.append((time.time() - start) * 1000.0)
+    samples.sort()
+    return {
+        "url": url,
+        "status": status,
+        "median_ms": round(samples[len(samples) // 2], 2),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+        "max_ms": round(samples[-1], 2),
+    }
+
 
 class Rstudio(CMakePackage):
     """RStudio is an integrated development environment (IDE) for R."""
@@ -28,6 +163,21 @@ class Rstudio(CMakePackage):
     )
     conflicts("~desktop", when="~server", msg="One of +server or +desktop must be set.")
 
+    # Release builds for both targets; LTO is available through the
+    # ipo variant of CMakePackage
+    variant(
+        "build_type",
+        default="Release",
+        description="CMake build type",
+        values=("Debug", "Release", "RelWithDebInfo", "MinSizeRel"),
+    )
+    variant("ninja", default=True, description="Build with Ninja.")
+    variant(
+        "gwt_cache",
+        default=True,
+        description="Reuse the GWT compile output of identical front-end sources.",
+    )
+
     variant("bioconductor", default=True, description="Install bioconductor.")
     variant("tidyverse", default=True, description="Install tidyverse.")
     variant("arrow", default=True, description="Install arrow")
@@ -51,6 +201,7 @@ class Rstudio(CMakePackage):
     depends_on("cmake@3.25.1:", type=("build"))
     # depends_on("pkgconfig", type="build")
     depends_on("ant", type="build")
+    depends_on("ninja", type="build", when="+ninja")
     # Could NOT find Boost (missing: atomic chrono date_time filesystem iostreams
     # program_options random regex system thread)
     depends_on(
@@ -138,6 +289,16 @@ class Rstudio(CMakePackage):
             string=True,
         )
 
+        tools = "dependencies/tools/rstudio-tools.sh"
+        if os.path.exists(tools):
+            with open(tools, "a") as f:
+                f.write(
+                    _download_override.format(
+                        python=sys.executable,
+                        tool=join_path(os.path.dirname(__file__), "artifact_cache.py"),
+                    )
+                )
+
         pandoc_dir = join_path(self.prefix.tools, "pandoc", self.spec["pandoc"].version)
         os.makedirs(pandoc_dir)
         with working_dir(pandoc_dir):
@@ -147,23 +308,50 @@ class Rstudio(CMakePackage):
                 "pandoc-citeproc",
             )
 
+    @property
+    def artifact_cache_dir(self):
+        """Cache shared by the dependency installers of all RStudio builds."""
+        return os.environ.get("RSTUDIO_ARTIFACT_CACHE") or join_path(
+            spack.caches.misc_cache.root, "rstudio-artifacts"
+        )
+
     @run_before("cmake")
     def install_deps(self):
-        dep_scripts = [
-            "./dependencies/common/install-dictionaries",
-            "./dependencies/common/install-mathjax",
-            "./dependencies/common/install-quarto",
+        """Run the dependency installers concurrently, each with its own log.
+
+        They unpack into separate directories of the tools root and only
+        share the artifact cache, which serializes its own updates.
+        """
+        common = join_path(self.stage.source_path, "dependencies", "common")
+        installers = [
+            ("dictionaries", self.stage.source_path, join_path(common, "install-dictionaries")),
+            ("mathjax", self.stage.source_path, join_path(common, "install-mathjax")),
+            ("quarto", self.stage.source_path, join_path(common, "install-quarto")),
+            ("npm-dependencies", common, "./install-npm-dependencies"),
         ]
-        for dep in dep_scripts:
-            deps = Executable(dep)
-            deps()
+        mkdirp(self.artifact_cache_dir)
 
-        cwd = os.getcwd()
-        os.chdir("dependencies/common")
-        deps = Executable("./install-npm-dependencies")
-        deps()
+        def run(installer):
+            name, cwd, script = installer
+            log = join_path(self.stage.path, "spack-build-deps-{0}.log".format(name))
+            start = time.time()
+            with open(log, "w") as out:
+                returncode = subprocess.call(
+                    [script], cwd=cwd, stdout=out, stderr=subprocess.STDOUT
+                )
+            if returncode != 0:
+                raise InstallError(
+                    "{0} failed with exit code {1}".format(script, returncode),
+                    long_msg="See {0}".format(log),
+                )
+            return name, time.time() - start
 
-        os.chdir(cwd)
+        with ThreadPoolExecutor(max_workers=len(installers)) as executor:
+            timings = list(executor.map(run, installers))
+        tty.msg(
+            "Installed the RStudio dependencies",
+            *["{0}: {1:.1f}s".format(name, seconds) for name, seconds in timings]
+        )
 
     def cmake_args(self):
         args = [
@@ -174,27 +362,246 @@ class Rstudio(CMakePackage):
 
         if "+server" in self.spec:
             args.append("-DRSTUDIO_TARGET=Server")
-            args.append("-DCMAKE_BUILD_TYPE=Release")
         else:
             args.append("-DRSTUDIO_TARGET=Electron")
             args.append("-DRSTUDIO_PACKAGE_BUILD=Yes")
 
+        # skip the ant build when the compiled front end was restored
+        if self._restore_gwt():
+            args.append("-DGWT_BUILD=No")
+
         return args
 
+    @property
+    def generator(self):
+        return "Ninja" if "+ninja" in self.spec else "Unix Makefiles"
+
+    def _artifact_cache(self):
+        """Open the artifact cache with the module shipped with this package."""
+        path = join_path(os.path.dirname(__file__), "artifact_cache.py")
+        module_spec = importlib.util.spec_from_file_location("rstudio_artifact_cache", path)
+        module = importlib.util.module_from_spec(module_spec)
+        module_spec.loader.exec_module(module)
+        return module.ArtifactCache(
+            self.artifact_cache_dir,
+            module.parse_size(os.environ.get("RSTUDIO_ARTIFACT_CACHE_MAXSIZE", "10G")),
+            timeout=float(os.environ.get("RSTUDIO_ARTIFACT_TIMEOUT", "60")),
+        )
+
+    @property
+    def gwt_cache_key(self):
+        """Hash of the GWT front-end sources and the tools compiling them.
+
+        Computed once, before the build adds anything to the sources.
+        """
+        if getattr(self, "_gwt_cache_key", None):
+            return self._gwt_cache_key
+        gwt = join_path(self.stage.source_path, "src", "gwt")
+        digest = hashlib.sha256()
+        digest.update(str(self.spec["java"].version).encode())
+        digest.update(str(self.spec["ant"].version).encode())
+        for path in ("build.xml", "src"):
+            for root, dirs, files in os.walk(join_path(gwt, path)):
+                dirs.sort()
+                for name in sorted(files):
+                    filename = join_path(root, name)
+                    digest.update(os.path.relpath(filename, gwt).encode())
+                    with open(filename, "rb") as f:
+                        digest.update(f.read())
+            if os.path.isfile(join_path(gwt, path)):
+                with open(join_path(gwt, path), "rb") as f:
+                    digest.update(f.read())
+        self._gwt_cache_key = "gwt:" + digest.hexdigest()
+        return self._gwt_cache_key
+
+    def _restore_gwt(self):
+        """Unpack the cached GWT output into src/gwt/www; False on a miss."""
+        if "+gwt_cache" not in self.spec:
+            return False
+        blob = self._artifact_cache().lookup(self.gwt_cache_key)
+        if blob is None:
+            return False
+        with blob, tarfile.open(fileobj=blob) as tar:
+            tar.extractall(join_path(self.stage.source_path, "src", "gwt"))
+        tty.msg("Restored the GWT compile output from the artifact cache")
+        return True
+
+    @run_after("build")
+    def cache_gwt(self):
+        """Store src/gwt/www after a GWT compile for later builds."""
+        www = join_path(self.stage.source_path, "src", "gwt", "www")
+        if "+gwt_cache" not in self.spec or not os.path.isdir(www):
+            return
+        cache = self._artifact_cache()
+        key = self.gwt_cache_key
+        blob = cache.lookup(key)
+        if blob is not None:
+            blob.close()
+            return
+        fd, tmp = tempfile.mkstemp(dir=cache.root, prefix=".gwt-", suffix=".tar.gz")
+        os.close(fd)
+        with tarfile.open(tmp, "w:gz") as tar:
+            tar.add(www, arcname="www")
+        cache.add(key, tmp)
+
     def setup_build_environment(self, env):
         env.set("RSTUDIO_TOOLS_ROOT", self.prefix.tools)
+        # Downloads and package manager caches survive the build stage
+        cache = self.artifact_cache_dir
+        env.set("RSTUDIO_ARTIFACT_CACHE", cache)
+        env.set("YARN_CACHE_FOLDER", join_path(cache, "yarn"))
+        env.set("npm_config_cache", join_path(cache, "npm"))
+
+    @property
+    def site_library(self):
+        """Single R library linking the packages of all R dependencies."""
+        return join_path(self.prefix, "rlib", "R", "site-library")
+
+    @property
+    def site_profile(self):
+        """R_PROFILE loading the package index of ``site_library``."""
+        return join_path(self.prefix, "rlib", "R", "Rprofile.site")
+
+    @run_after("install")
+    def link_site_library(self):
+        """Merge the libraries of the R dependencies into ``site_library``.
+
+        Each R package lives in its own prefix, so R would scan one library
+        per dependency on every session start. The packages are linked into
+        one directory instead, which R_LIBS_SITE points to. Their DESCRIPTION
+        files are indexed next to it, and ``site_profile`` hands the index to
+        installed.packages() when a session starts.
+        """
+        site = self.site_library
+        if os.path.lexists(site):
+            shutil.rmtree(site)
+        mkdirp(site)
+
+        linked = {}
+        for dep in self.spec.traverse(root=False, order="pre"):
+            if not dep.name.startswith("r-"):
+                continue
+            library = join_path(dep.prefix, "rlib", "R", "library")
+            if not os.path.isdir(library):
+                continue
+            for name in sorted(os.listdir(library)):
+                source = join_path(library, name)
+                if not os.path.isfile(join_path(source, "DESCRIPTION")):
+                    continue
+                if name in linked:
+                    if linked[name] != source:
+                        tty.warn(
+                            "R package {0} provided by {1} and {2}, using the first".format(
+                                name, linked[name], source
+                            )
+                        )
+                    continue
+                os.symlink(source, join_path(site, name))
+                linked[name] = source
+
+        tty.msg("Linked {0} R packages into {1}".format(len(linked), site))
+
+        index = site + ".rds"
+        script = join_path(self.stage.path, "site-library-index.R")
+        with open(script, "w") as f:
+            f.write(_index_script)
+        Executable(join_path(self.spec["r"].prefix.bin, "Rscript"))(script, site, index)
+        with open(self.site_profile, "w") as f:
+            f.write(_site_profile.replace("@INDEX@", index).replace("@SITE@", site))
+
+    # sequential requests timed per URL by the server benchmark
+    benchmark_requests = 20
+
+    def test(self):
+        """Benchmark the startup and request latency of rserver and rsession.
+
+        Both run on loopback ports as the current user, with no
+        authentication and a throwaway configuration, database and data
+        directory in the test stage. Results go to rstudio-benchmark.json.
+        """
+        if "+server" not in self.spec:
+            return
+        user = getpass.getuser()
+        work = join_path(os.getcwd(), "rstudio-benchmark")
+        for subdir in ("config", "data", "db", "home"):
+            mkdirp(join_path(work, subdir))
+        with open(join_path(work, "database.conf"), "w") as f:
+            f.write("provider=sqlite\ndirectory={0}\n".format(join_path(work, "db")))
+
+        env = dict(os.environ)
+        env.update(
+            {
+                "RSTUDIO_CONFIG_DIR": join_path(work, "config"),
+                "RSTUDIO_CONFIG_HOME": join_path(work, "config"),
+                "RSTUDIO_DATA_HOME": join_path(work, "home"),
+                "RSTUDIO_WHICH_R": join_path(self.spec["r"].prefix.bin, "R"),
+                "R_LIBS_SITE": self.site_library,
+                "R_PROFILE": self.site_profile,
+            }
+        )
+        report = {
+            "spec": self.spec.format("{name}{@version}{%compiler}{variants}"),
+            "r": str(self.spec["r"].version),
+            "r_packages": len(os.listdir(self.site_library))
+            if os.path.isdir(self.site_library)
+            else 0,
+        }
+
+        rserver_port, rsession_port = _free_port(), _free_port()
+        rserver = [
+            self.prefix.bin.rserver,
+            "--www-address=127.0.0.1",
+            "--www-port={0}".format(rserver_port),
+            "--server-user={0}".format(user),
+            "--server-daemonize=0",
+            "--auth-none=1",
+            "--server-data-dir={0}".format(join_path(work, "data")),
+            "--database-config-file={0}".format(join_path(work, "database.conf")),
+            "--secure-cookie-key-file={0}".format(join_path(work, "secure-cookie-key")),
+            "--rsession-which-r={0}".format(env["RSTUDIO_WHICH_R"]),
+        ]
+        rsession = [
+            self.prefix.bin.rsession,
+            "--standalone=1",
+            "--program-mode=server",
+            "--log-stderr=1",
+            "--user-identity={0}".format(user),
+            "--www-address=127.0.0.1",
+            "--www-port={0}".format(rsession_port),
+        ]
+        for name, command, port, paths in (
+            ("rserver", rserver, rserver_port, ["/", "/auth-sign-in", "/favicon.ico"]),
+            ("rsession", rsession, rsession_port, ["/"]),
+        ):
+            base = "http://127.0.0.1:{0}".format(port)
+            with open(join_path(work, name + ".log"), "w") as log:
+                process = subprocess.Popen(
+                    command, env=env, cwd=work, stdout=log, stderr=subprocess.STDOUT
+                )
+                try:
+                    ready = _wait_ready(process, base + "/", timeout=120)
+                    report[name] = {
+                        "ready_seconds": round(ready, 3),
+                        "rss_kb": _rss_kb(process.pid),
+                        "requests": [_latency(base + p, self.benchmark_requests) for p in paths],
+                    }
+                finally:
+                    process.terminate()
+                    try:
+                        process.wait(timeout=30)
+                    except subprocess.TimeoutExpired:
+                        process.kill()
+            tty.msg(
+                "{0}: ready in {1}s, {2} kB resident".format(
+                    name, report[name]["ready_seconds"], report[name]["rss_kb"]
+                )
+            )
+
+        filename = join_path(os.getcwd(), "rstudio-benchmark.json")
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+        tty.msg("Benchmark results saved to {0}".format(filename))
 
-    # @run_before("install")
-    # def symlink_all_the_things(self):
-    #     """RStudio Server OSS will only allow for the system libPaths and the User libPaths"""
-    #
-    #     base_r_lib_dir = os.path.join(self.spec["r"].prefix, "rlib", "R", "library")
-    #     for package in r_packages:
-    #         prefix = self.spec[package].prefix
-    #         r_lib = os.path.join(prefix, "rlib", "R", "library")
-    #         package_libs = os.listdir(r_lib)
-    #         for package_lib in package_libs:
-    #             package_lib = os.path.join(r_lib, package_lib)
-    #             os.symlink(base_r_lib_dir, package_lib)
-    #
-    #     return
+    def setup_run_environment(self, env):
+        env.set("R_LIBS_SITE", self.site_library)
+        env.set("R_PROFILE", self.site_profile)